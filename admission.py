@@ -0,0 +1,177 @@
+import os
+import math
+import time
+import random
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
+from fastapi import HTTPException, status
+from groq import RateLimitError, InternalServerError, APIConnectionError
+import metrics
+
+load_dotenv()
+
+MODEL_MAX_CONCURRENCY = int(os.getenv('MODEL_MAX_CONCURRENCY', 16))   #Model calls in flight across all users
+MODEL_MAX_PER_USER = int(os.getenv('MODEL_MAX_PER_USER', 2))   #Model calls in flight for one user
+MODEL_QUEUE_SIZE = int(os.getenv('MODEL_QUEUE_SIZE', 200))   #Requests waiting for a slot across all users
+MODEL_USER_QUEUE_SIZE = int(os.getenv('MODEL_USER_QUEUE_SIZE', 4))   #Requests waiting for a slot for one user
+MODEL_QUEUE_TIMEOUT = float(os.getenv('MODEL_QUEUE_TIMEOUT', 30))
+UPSTREAM_MAX_RETRIES = int(os.getenv('UPSTREAM_MAX_RETRIES', 3))
+UPSTREAM_RETRY_BASE = float(os.getenv('UPSTREAM_RETRY_BASE', 0.5))
+UPSTREAM_RETRY_MAX = float(os.getenv('UPSTREAM_RETRY_MAX', 20))
+RETRYABLE_ERRORS = (RateLimitError, InternalServerError, APIConnectionError)
+
+model_calls_in_flight = metrics.Gauge('assistant_model_calls_in_flight', 'Model calls holding an admission slot.')
+model_calls_waiting = metrics.Gauge('assistant_model_calls_waiting', 'Model calls waiting for an admission slot.')
+admission_rejections = metrics.Counter('assistant_admission_rejections_total', 'Model calls turned away by the admission limiter.', ['reason'])
+upstream_retries = metrics.Counter('assistant_upstream_retries_total', 'Model API calls retried after a retryable error.', ['error'])
+
+
+def overloaded(reason, retry_after):
+    admission_rejections.inc(reason=reason)
+    status_code = status.HTTP_429_TOO_MANY_REQUESTS if reason == 'user_queue_full' else status.HTTP_503_SERVICE_UNAVAILABLE
+    detail = "Too many requests in progress." if reason == 'user_queue_full' else "The assistant is busy, please retry shortly."
+    return HTTPException(status_code=status_code, detail=detail, headers={'Retry-After': str(retry_after)})
+
+
+class AdmissionLimiter:
+    '''Caps model calls in flight, globally and per user, with a bounded wait queue.
+
+    Freed slots go to waiting users in turn, so one user with many requests cannot starve the others.'''
+
+    def __init__(self, max_concurrency=MODEL_MAX_CONCURRENCY, max_per_user=MODEL_MAX_PER_USER, queue_size=MODEL_QUEUE_SIZE,
+                 user_queue_size=MODEL_USER_QUEUE_SIZE, timeout=MODEL_QUEUE_TIMEOUT):
+        self.max_concurrency = max_concurrency
+        self.max_per_user = max_per_user
+        self.queue_size = queue_size
+        self.user_queue_size = user_queue_size
+        self.timeout = timeout
+        self.active = {}
+        self.in_flight = 0
+        self.queues = OrderedDict()
+        self.waiting = 0
+        self.call_seconds = 1.0   #Moving average, used to suggest when to retry
+
+    def retry_after(self):
+        return max(1, math.ceil(self.call_seconds*(self.waiting + 1)/self.max_concurrency))
+
+    def admit(self, user):
+        self.in_flight += 1
+        self.active[user] = self.active.get(user, 0) + 1
+        model_calls_in_flight.set(self.in_flight)
+
+    async def acquire(self, user):
+        if self.in_flight < self.max_concurrency and self.active.get(user, 0) < self.max_per_user:
+            self.admit(user)
+            return time.perf_counter()
+        if len(self.queues.get(user, ())) >= self.user_queue_size:
+            raise overloaded('user_queue_full', self.retry_after())
+        if self.waiting >= self.queue_size:
+            raise overloaded('queue_full', self.retry_after())
+        admitted = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(user, deque()).append(admitted)
+        self.waiting += 1
+        model_calls_waiting.set(self.waiting)
+        try:
+            with metrics.span('admission_wait'):
+                await asyncio.wait_for(admitted, self.timeout)
+        except BaseException as error:
+            if admitted.done() and not admitted.cancelled():
+                self.release(user)   #Admitted just as the wait ended
+            else:
+                self.withdraw(user, admitted)
+            if isinstance(error, asyncio.TimeoutError):
+                raise overloaded('queue_timeout', self.retry_after()) from None
+            raise
+        return time.perf_counter()
+
+    def withdraw(self, user, admitted):
+        queue = self.queues.get(user)
+        if queue and admitted in queue:
+            queue.remove(admitted)
+            self.waiting -= 1
+            model_calls_waiting.set(self.waiting)
+            if not queue:
+                del self.queues[user]
+
+    def release(self, user, started=None):
+        if started is not None:
+            self.call_seconds = 0.9*self.call_seconds + 0.1*(time.perf_counter() - started)
+        self.in_flight -= 1
+        self.active[user] -= 1
+        if not self.active[user]:
+            del self.active[user]
+        model_calls_in_flight.set(self.in_flight)
+        self.dispatch()
+
+    def dispatch(self):
+        # Round robin over the users with waiting requests who are below their own limit
+        while self.in_flight < self.max_concurrency:
+            user = next((user for user in self.queues if self.active.get(user, 0) < self.max_per_user), None)
+            if user is None:
+                return
+            queue = self.queues.pop(user)
+            admitted = queue.popleft()
+            self.waiting -= 1
+            model_calls_waiting.set(self.waiting)
+            if queue:
+                self.queues[user] = queue
+            if not admitted.done():
+                self.admit(user)
+                admitted.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, user):
+        started = await self.acquire(user)
+        try:
+            yield
+        finally:
+            self.release(user, started)
+
+
+
+'''Upstream retries'''
+
+def retry_delay(error, attempt):
+    # The provider's Retry-After wins when given; otherwise exponential backoff with full jitter
+    response = getattr(error, 'response', None)
+    retry_after = response.headers.get('retry-after') if response is not None else None
+    try:
+        return min(float(retry_after), UPSTREAM_RETRY_MAX) + random.uniform(0, UPSTREAM_RETRY_BASE)
+    except (TypeError, ValueError):
+        return random.uniform(0, min(UPSTREAM_RETRY_BASE*2**attempt, UPSTREAM_RETRY_MAX))
+
+def upstream_unavailable(error):
+    delay = retry_delay(error, UPSTREAM_MAX_RETRIES)
+    return HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                         detail="The model provider is busy, please retry shortly.",
+                         headers={'Retry-After': str(max(1, math.ceil(delay)))})
+
+async def with_retries(call):
+    # call makes a new request each time it is called
+    for attempt in range(UPSTREAM_MAX_RETRIES + 1):
+        try:
+            return await call()
+        except RETRYABLE_ERRORS as error:
+            if attempt == UPSTREAM_MAX_RETRIES:
+                raise upstream_unavailable(error) from error
+            upstream_retries.inc(error=type(error).__name__)
+            await asyncio.sleep(retry_delay(error, attempt))
+
+async def stream_with_retries(stream):
+    # stream returns a new async iterator each time; it is only retried until the first chunk has been received
+    for attempt in range(UPSTREAM_MAX_RETRIES + 1):
+        started = False
+        try:
+            async for chunk in stream():
+                started = True
+                yield chunk
+            return
+        except RETRYABLE_ERRORS as error:
+            if started:
+                raise
+            if attempt == UPSTREAM_MAX_RETRIES:
+                raise upstream_unavailable(error) from error
+            upstream_retries.inc(error=type(error).__name__)
+            await asyncio.sleep(retry_delay(error, attempt))
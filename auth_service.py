@@ -7,17 +7,28 @@ import jwt
 from jwt import PyJWTError
 from passlib.context import CryptContext
 import logging
+import time
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from uuid import UUID
+import metrics
 
 load_dotenv()
 secret_key = os.getenv('SECRET_KEY')
 
 ALGORITHM = "HS256"
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', 2))
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 300))   #seconds
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 logging.getLogger('passlib').setLevel(logging.ERROR)
 
+# bcrypt is CPU bound, so it runs on a small dedicated pool instead of the event loop
+hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix='bcrypt')
+
 
 class User(BaseModel):
     id: UUID
@@ -37,6 +48,36 @@ class Token(AccessToken):
 
 class TokenData(BaseModel):
     username: str
+    id: UUID | None = None
+    email: str | None = None
+    refresh: bool = False
+
+class TTLCache:
+    def __init__(self, ttl=USER_CACHE_TTL, max_size=USER_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            self.entries.pop(key, None)
+            return None
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+user_cache = TTLCache()
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -44,21 +85,44 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):    
     return pwd_context.hash(password)  
 
-def get_user(db, username: str):
-    user = db.select_user_by_username(username)
+async def averify_password(plain_password, hashed_password):
+    loop = asyncio.get_running_loop()
+    with metrics.span('password_verify'):
+        return await loop.run_in_executor(hash_executor, verify_password, plain_password, hashed_password)
+
+async def aget_password_hash(password):
+    loop = asyncio.get_running_loop()
+    with metrics.span('password_hash'):
+        return await loop.run_in_executor(hash_executor, get_password_hash, password)
+
+async def get_user(db, username: str):
+    cached = user_cache.get(username)
+    if cached:
+        return cached
+    with metrics.span('get_user'):
+        user = await db.select_user_by_username(username)
     if not user:
         return False
     dic={'id':user[0],'username':user[1],'email':user[2],'hashed_password':user[3]}
-    return UserInDB(**dic)
+    user = UserInDB(**dic)
+    user_cache.put(username, user)
+    return user
+
+def invalidate_user(username: str):
+    user_cache.invalidate(username)
 
-def authenticate_user(db, username, password):
-    user = get_user(db, username)
+async def authenticate_user(db, username, password):
+    user = await get_user(db, username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await averify_password(password, user.hashed_password):
         return False
     return user
 
+def token_claims(user):
+    # Carried in every token so authorized routes need no user lookup
+    return {'sub':user.username, 'uid':str(user.id), 'email':user.email}
+
 def create_token(data, expires_delta, refresh: bool = False):
     to_encode = data.copy()
     expire = datetime.now() + timedelta(minutes=expires_delta)
@@ -73,15 +137,26 @@ async def current_user(token = Depends(OAuth2PasswordBearer(tokenUrl="login"))):
         headers={"WWW-Authenticate": "Bearer"}
     )
     try:
-        payload = jwt.decode(token, secret_key, algorithms=[ALGORITHM])
-        username = payload.get('sub')
-        if not username:
-            raise credentials_exception
-        token_data = TokenData(username=username)
-    except PyJWTError:
+        with metrics.span('auth'):
+            payload = jwt.decode(token, secret_key, algorithms=[ALGORITHM])
+            username = payload.get('sub')
+            if not username:
+                raise credentials_exception
+            token_data = TokenData(username=username, id=payload.get('uid'), email=payload.get('email'), refresh=bool(payload.get('refresh')))
+    except (PyJWTError, ValueError):
         raise credentials_exception
     return token_data   #Did not use get_user() here because we are not using the database in this module
 
+async def authorized_user(token_data: TokenData = Depends(current_user)):
+    # Refresh tokens live for days and are only accepted by /token/, which checks that the user still exists
+    if token_data.id is None or token_data.refresh:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    return token_data
+
 async def get_current_active_user(current_user: User = Depends(current_user)):
     if current_user.disabled:
         raise HTTPException(status_code=400, detail="Inactive user")
@@ -0,0 +1,229 @@
+'''Local stand-ins for Groq, LLMWhisperer and Redis, so the app can be benchmarked without network services.'''
+
+import time
+import random
+import asyncio
+from types import SimpleNamespace
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+WORDS = ('the', 'model', 'session', 'document', 'answer', 'request', 'latency', 'cache', 'token', 'stream',
+         'summary', 'context', 'index', 'chunk', 'query', 'result', 'database', 'image', 'user', 'title')
+
+
+def fake_text(seed, words):
+    rng = random.Random(seed)
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+
+'''Language and vision models'''
+
+class FakeChatModel(BaseChatModel):
+    '''Chat model that answers after a fixed time to first token and then produces tokens at a fixed rate.'''
+
+    first_token_latency: float = 0.3
+    tokens_per_second: float = 200
+    response_tokens: int = 80
+
+    @property
+    def _llm_type(self):
+        return 'benchmark-fake'
+
+    def reply(self, messages):
+        seed = sum(len(str(message.content)) for message in messages)
+        return fake_text(seed, self.response_tokens).split()
+
+    def generation_time(self, tokens):
+        return self.first_token_latency + len(tokens)/self.tokens_per_second
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        tokens = self.reply(messages)
+        time.sleep(self.generation_time(tokens))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=' '.join(tokens)))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        tokens = self.reply(messages)
+        await asyncio.sleep(self.generation_time(tokens))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=' '.join(tokens)))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        tokens = self.reply(messages)
+        await asyncio.sleep(self.first_token_latency)
+        for position, token in enumerate(tokens):
+            await asyncio.sleep(1/self.tokens_per_second)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token if position == 0 else ' ' + token))
+
+
+class FakeVisionClient:
+    '''Stands in for AsyncGroq, answering chat.completions.create after a fixed latency.'''
+
+    def __init__(self, latency=0.8, response_tokens=60):
+        self.latency = latency
+        self.response_tokens = response_tokens
+        self.chat = SimpleNamespace(completions=self)
+
+    async def create(self, messages, model, **kwargs):
+        await asyncio.sleep(self.latency)
+        text = fake_text(len(messages[0]['content'][1]['image_url']['url']), self.response_tokens)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))])
+
+
+
+'''Document extraction'''
+
+class FakeExtractor:
+    '''Returns generated text for each document after a base latency plus a per-megabyte cost.'''
+
+    def __init__(self, latency=1.0, seconds_per_mb=2.0, words=3000):
+        self.latency = latency
+        self.seconds_per_mb = seconds_per_mb
+        self.words = words
+
+    async def extract(self, documents, timeout=None):
+        size = sum(len(document.data) for document in documents)
+        await asyncio.sleep(self.latency + self.seconds_per_mb*size/1048576)
+        return [fake_text(document.digest, self.words) for document in documents]
+
+    def close(self):
+        pass
+
+
+
+'''Redis'''
+
+def encode(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+
+class FakeRedis:
+    '''In-process subset of redis.asyncio.Redis covering the commands used by cache.Cache, including key expiry.'''
+
+    def __init__(self):
+        self.data = {}
+        self.expiry = {}
+
+    def lookup(self, key, default=None):
+        deadline = self.expiry.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            self.data.pop(key, None)
+            self.expiry.pop(key, None)
+        return self.data.get(key, default)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    async def get(self, key):
+        return self.lookup(key)
+
+    async def set(self, key, value, ex=None):
+        self.data[key] = encode(value)
+        if ex:
+            self.expiry[key] = time.monotonic() + ex
+        else:
+            self.expiry.pop(key, None)
+        return True
+
+    async def delete(self, *keys):
+        deleted = 0
+        for key in keys:
+            if self.lookup(key) is not None:
+                deleted += 1
+            self.data.pop(key, None)
+            self.expiry.pop(key, None)
+        return deleted
+
+    async def expire(self, key, seconds):
+        if self.lookup(key) is None:
+            return False
+        self.expiry[key] = time.monotonic() + seconds
+        return True
+
+    async def rpush(self, key, *values):
+        items = self.lookup(key)
+        if items is None:
+            items = self.data[key] = []
+        items.extend(encode(value) for value in values)
+        return len(items)
+
+    async def lrange(self, key, start, end):
+        items = self.lookup(key, [])
+        start = max(len(items) + start, 0) if start < 0 else start
+        end = len(items) + end if end < 0 else end
+        return items[start:end + 1]
+
+    async def hset(self, key, field=None, value=None, mapping=None):
+        fields = self.lookup(key)
+        if fields is None:
+            fields = self.data[key] = {}
+        items = dict(mapping or {})
+        if field is not None:
+            items[field] = value
+        added = sum(encode(name) not in fields for name in items)
+        fields.update({encode(name): encode(item) for name, item in items.items()})
+        return added
+
+    async def hget(self, key, field):
+        return self.lookup(key, {}).get(encode(field))
+
+    async def hgetall(self, key):
+        return dict(self.lookup(key, {}))
+
+    async def zadd(self, key, mapping):
+        members = self.lookup(key)
+        if members is None:
+            members = self.data[key] = {}
+        added = sum(encode(member) not in members for member in mapping)
+        members.update({encode(member): float(score) for member, score in mapping.items()})
+        return added
+
+    async def zremrangebyscore(self, key, min, max):
+        members = self.lookup(key, {})
+        removed = [member for member, score in members.items() if float(min) <= score <= float(max)]
+        for member in removed:
+            del members[member]
+        return len(removed)
+
+    async def zcard(self, key):
+        return len(self.lookup(key, {}))
+
+    async def zrange(self, key, start, end):
+        members = sorted(self.lookup(key, {}).items(), key=lambda item: (item[1], item[0]))
+        start = max(len(members) + start, 0) if start < 0 else start
+        end = len(members) + end if end < 0 else end
+        return [member for member, _ in members[start:end + 1]]
+
+    async def zrem(self, key, *members):
+        entries = self.lookup(key, {})
+        return sum(entries.pop(encode(member), None) is not None for member in members)
+
+    async def aclose(self):
+        pass
+
+
+class FakePipeline:
+    '''Queues commands and runs them back to back on execute(); nothing else runs in between, as with MULTI/EXEC.'''
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self.client, name)
+        def queue(*args, **kwargs):
+            self.commands.append((command, args, kwargs))
+            return self
+        return queue
+
+    async def execute(self):
+        commands, self.commands = self.commands, []
+        return [await command(*args, **kwargs) for command, args, kwargs in commands]
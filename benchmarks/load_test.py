@@ -0,0 +1,406 @@
+'''Offline load test for main.app.
+
+The app is served in process by uvicorn against fake model, vision and extraction backends (benchmarks.fakes),
+an in-process Redis and a local SQLite database, or any database given with --database-url. Concurrent virtual
+users register, log in and then send a weighted mix of requests until the run ends. Latency percentiles and
+requests per second are reported per route and saved as JSON, which later runs can be compared against.
+
+    python -m benchmarks.load_test --concurrency 20 --duration 60 --output baseline.json
+    python -m benchmarks.load_test --concurrency 20 --duration 60 --compare baseline.json
+'''
+
+import os
+import io
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+from collections import defaultdict
+from datetime import datetime, timezone
+
+DEFAULT_MIX = 'text=45,list=25,history=10,document=6,image=6,login=3,stream=5'
+TOKEN_REFRESH_SECONDS = 45   #Access tokens expire after a minute
+RECORDED_SETTINGS = ('WRITE_BEHIND', 'RESPONSE_CACHE_ROUTES', 'DB_POOL_SIZE', 'DB_MAX_OVERFLOW', 'PASSWORD_HASH_WORKERS',
+                     'CONTEXT_TOKEN_BUDGET', 'IMAGE_MAX_DIMENSION', 'EXTRACTION_MAX_CONCURRENCY', 'MODEL_MAX_CONCURRENCY',
+                     'MODEL_MAX_PER_USER', 'MODEL_QUEUE_SIZE', 'MODEL_USER_QUEUE_SIZE', 'MODEL_QUEUE_TIMEOUT', 'MODEL_ROUTES',
+                     'SMALL_MESSAGE_TOKENS', 'SMALL_PROMPT_TOKENS')
+
+# SQLite has no identity columns, so chats.seq is filled from the rowid instead
+SQLITE_SEQ_TRIGGER = '''CREATE TRIGGER IF NOT EXISTS chats_seq AFTER INSERT ON chats WHEN NEW.seq IS NULL
+BEGIN UPDATE chats SET seq = NEW.rowid WHERE rowid = NEW.rowid; END'''
+
+QUESTIONS = ('What are the main points so far?', 'Can you explain that in more detail?', 'Summarize the last answer.',
+             'What should I do next?', 'Give me three examples.', 'How does this compare to the alternatives?')
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(','):
+        route, weight = item.split('=')
+        weights[route.strip()] = float(weight)
+    unknown = set(weights) - set(VirtualUser.ACTIONS)
+    if unknown:
+        raise argparse.ArgumentTypeError(f"Unknown routes in mix: {', '.join(sorted(unknown))}")
+    return weights
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Offline load test for the assistant API.')
+    parser.add_argument('--concurrency', type=int, default=10, help='Virtual users sending requests at the same time.')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds of measured traffic.')
+    parser.add_argument('--warmup', type=float, default=5, help='Seconds of traffic before measuring starts.')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f'Route weights (default "{DEFAULT_MIX}").')
+    parser.add_argument('--think-time', type=float, default=0, help='Mean pause between requests of a user, in seconds.')
+    parser.add_argument('--new-session-rate', type=float, default=0.1, help='Chance that a chat request starts a new session.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database-url', help='Database to use instead of a temporary SQLite file.')
+    parser.add_argument('--llm-latency', type=float, default=0.3, help='Seconds to the first token of the fake model.')
+    parser.add_argument('--llm-tokens-per-second', type=float, default=200)
+    parser.add_argument('--llm-response-tokens', type=int, default=80)
+    parser.add_argument('--small-llm-speedup', type=float, default=3, help='How much faster the small model tier answers.')
+    parser.add_argument('--vision-latency', type=float, default=0.8)
+    parser.add_argument('--extraction-latency', type=float, default=1.0)
+    parser.add_argument('--extraction-seconds-per-mb', type=float, default=2.0)
+    parser.add_argument('--documents', type=int, default=20, help='Distinct documents uploaded, repeats hit the extraction cache.')
+    parser.add_argument('--document-kb', type=int, default=200)
+    parser.add_argument('--images', type=int, default=10, help='Distinct images uploaded.')
+    parser.add_argument('--image-size', default='1600x1200')
+    parser.add_argument('--output', help='Where to save the results (default benchmarks/results/<time>.json).')
+    parser.add_argument('--compare', help='Earlier results to compare against; exits with status 1 on a regression.')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed relative p95 increase or throughput drop.')
+    return parser.parse_args(argv)
+
+
+
+'''Setup'''
+
+def configure_environment(args, directory):
+    # Runs before main is imported, since the database, caches and loaders read their settings at import time
+    os.environ['DATABASE_URL'] = args.database_url or f"sqlite+aiosqlite:///{os.path.join(directory, 'benchmark.db')}"
+    if os.environ['DATABASE_URL'].startswith('sqlite'):
+        # SQLite allows one writer at a time, so a single pooled connection avoids lock errors
+        os.environ['DB_POOL_SIZE'] = '1'
+        os.environ['DB_MAX_OVERFLOW'] = '0'
+    os.environ['REDIS_URL'] = 'redis://localhost:6379/0'   #Never connected to, the client is replaced by FakeRedis
+    os.environ['EXTRACTION_CACHE_DIR'] = os.path.join(directory, 'extraction_cache')
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+async def prepare_app(args):
+    import main
+    from sqlalchemy import text
+    from models import base_model, image_model
+    from benchmarks.fakes import FakeChatModel, FakeVisionClient, FakeExtractor, FakeRedis
+
+    main.r.client = FakeRedis()
+    large = FakeChatModel(first_token_latency=args.llm_latency,
+                          tokens_per_second=args.llm_tokens_per_second,
+                          response_tokens=args.llm_response_tokens)
+    small = FakeChatModel(first_token_latency=args.llm_latency/args.small_llm_speedup,
+                          tokens_per_second=args.llm_tokens_per_second*args.small_llm_speedup,
+                          response_tokens=args.llm_response_tokens)
+    models = {base_model.SMALL_MODEL: small, base_model.LARGE_MODEL: large}
+    base_model.load_model = lambda model_name=base_model.MODEL: models.get(model_name, large)
+    vision = FakeVisionClient(latency=args.vision_latency)
+    image_model.load_async_client = lambda: vision
+    main.dm.extractors = {'local': FakeExtractor(args.extraction_latency, args.extraction_seconds_per_mb)}
+
+    db = main.db
+    if db.engine.dialect.name == 'sqlite':
+        db.chats_table.c.seq.nullable = True
+        await db.create_tables()
+        async with db.engine.begin() as conn:
+            await conn.execute(text(SQLITE_SEQ_TRIGGER))
+    else:
+        await db.create_tables()
+        await db.migrate()
+    return main
+
+def make_documents(count, size_kb, seed):
+    rng = random.Random(seed)
+    return [(f'document-{number}.pdf', rng.randbytes(size_kb*1024)) for number in range(count)]
+
+def make_images(count, size, seed):
+    from PIL import Image
+    rng = random.Random(seed)
+    width, height = (int(value) for value in size.split('x'))
+    images = []
+    for number in range(count):
+        # Upscaled noise compresses like a photo rather than like pure noise
+        noise = Image.frombytes('RGB', (width//16, height//16), rng.randbytes((width//16)*(height//16)*3))
+        image = noise.resize((width, height), Image.BICUBIC)
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=90)
+        images.append((f'image-{number}.jpg', buffer.getvalue()))
+    return images
+
+
+
+'''Traffic'''
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.recording = False
+
+    def record(self, route, seconds, ok):
+        if not self.recording:
+            return
+        self.latencies[route].append(seconds)
+        if not ok:
+            self.errors[route] += 1
+
+
+def sse_result(body):
+    # The final event of a streamed turn carries the chat and the session id
+    event = None
+    for line in body.splitlines():
+        if line.startswith('event: '):
+            event = line[len('event: '):]
+        elif line.startswith('data: ') and event in ('end', 'error'):
+            return event, json.loads(line[len('data: '):])
+    return None, None
+
+
+class VirtualUser:
+    ACTIONS = ('text', 'stream', 'document', 'image', 'list', 'history', 'login')
+
+    def __init__(self, number, run_id, client, recorder, args, documents, images):
+        self.username = f'bench-{run_id}-{number}'
+        self.password = f'password-{number}'
+        self.client = client
+        self.recorder = recorder
+        self.args = args
+        self.documents = documents
+        self.images = images
+        self.rng = random.Random(args.seed*100003 + number)
+        self.routes = list(args.mix)
+        self.weights = [args.mix[route] for route in self.routes]
+        self.access_token = None
+        self.refresh_token = None
+        self.token_time = 0
+        self.session_id = None
+
+    def headers(self):
+        return {'Authorization': f'Bearer {self.access_token}'} if self.access_token else {}
+
+    async def request(self, route, method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, headers=self.headers(), **kwargs)
+            ok = response.status_code < 400
+            if ok and response.headers.get('content-type', '').startswith('application/json'):
+                body = response.json()
+                ok = not (isinstance(body, dict) and 'Error' in body)
+            elif ok and route == 'stream':
+                event, body = sse_result(response.text)
+                ok = event == 'end'
+            else:
+                body = None
+        except Exception:
+            ok, body = False, None
+        self.recorder.record(route, time.perf_counter() - start, ok)
+        return body if ok else None
+
+    async def run(self, stop):
+        await self.request('register', 'POST', '/register/',
+                           data={'username':self.username, 'email':f'{self.username}@example.com', 'password':self.password})
+        await self.login()
+        while not stop.is_set():
+            if time.monotonic() - self.token_time > TOKEN_REFRESH_SECONDS:
+                await self.refresh()
+            route = self.rng.choices(self.routes, self.weights)[0]
+            await getattr(self, route)()
+            if self.args.think_time:
+                await asyncio.sleep(self.rng.expovariate(1/self.args.think_time))
+
+    async def login(self):
+        body = await self.request('login', 'POST', '/login/', data={'username':self.username, 'password':self.password})
+        if body:
+            self.access_token, self.refresh_token = body['access_token'], body['refresh_token']
+            self.token_time = time.monotonic()
+
+    async def refresh(self):
+        body = await self.request('refresh', 'POST', '/token/', data={'refresh_token':self.refresh_token})
+        if body:
+            self.access_token = body['access_token']
+            self.token_time = time.monotonic()
+        else:
+            await self.login()
+
+    def chat_session(self):
+        if self.session_id is None or self.rng.random() < self.args.new_session_rate:
+            return 'new'
+        return self.session_id
+
+    def keep_session(self, body):
+        if body and 'session_id' in body:
+            self.session_id = str(body['session_id'])
+
+    async def text(self):
+        body = await self.request('text', 'POST', f'/user/chats/{self.chat_session()}/text/',
+                                  data={'text':self.rng.choice(QUESTIONS)})
+        self.keep_session(body)
+
+    async def stream(self):
+        body = await self.request('stream', 'POST', f'/user/chats/{self.chat_session()}/text/',
+                                  data={'text':self.rng.choice(QUESTIONS), 'stream':'true'})
+        self.keep_session(body)
+
+    async def document(self):
+        filename, data = self.rng.choice(self.documents)
+        body = await self.request('document', 'POST', f'/user/chats/{self.chat_session()}/document/',
+                                  data={'text':self.rng.choice(QUESTIONS)},
+                                  files={'file':(filename, data, 'application/pdf')})
+        self.keep_session(body)
+
+    async def image(self):
+        filename, data = self.rng.choice(self.images)
+        body = await self.request('image', 'POST', f'/user/chats/{self.chat_session()}/image/',
+                                  data={'text':'What is in this image?'},
+                                  files={'file':(filename, data, 'image/jpeg')})
+        self.keep_session(body)
+
+    async def list(self):
+        await self.request('list', 'GET', '/user/chats/')
+
+    async def history(self):
+        if self.session_id is None:
+            return await self.list()
+        await self.request('history', 'GET', f'/user/chats/{self.session_id}/')
+
+
+
+'''Results'''
+
+def percentile(values, fraction):
+    # Nearest rank on sorted values
+    return values[max(int(round(fraction*len(values))) - 1, 0)]
+
+def route_stats(latencies, errors, elapsed):
+    values = sorted(latencies)
+    return {'requests': len(values),
+            'errors': errors,
+            'requests_per_second': len(values)/elapsed,
+            'mean_ms': 1000*sum(values)/len(values),
+            'p50_ms': 1000*percentile(values, 0.50),
+            'p95_ms': 1000*percentile(values, 0.95),
+            'p99_ms': 1000*percentile(values, 0.99),
+            'max_ms': 1000*values[-1]}
+
+def summarize(recorder, elapsed):
+    routes = {route: route_stats(latencies, recorder.errors[route], elapsed)
+              for route, latencies in sorted(recorder.latencies.items())}
+    everything = [latency for latencies in recorder.latencies.values() for latency in latencies]
+    total = route_stats(everything, sum(recorder.errors.values()), elapsed) if everything else None
+    return routes, total
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_table(results):
+    print(f"{'route':<10}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    rows = list(results['routes'].items()) + ([('total', results['total'])] if results['total'] else [])
+    for route, stats in rows:
+        print(f"{route:<10}{stats['requests']:>10}{stats['errors']:>8}{stats['requests_per_second']:>10.1f}"
+              f"{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}")
+
+def compare(results, baseline, tolerance):
+    # A route regresses when its p95 rises or its throughput falls by more than the tolerance
+    regressions = []
+    print(f"\n{'route':<10}{'p95 ms':>22}{'req/s':>22}")
+    for route, stats in results['routes'].items():
+        before = baseline['routes'].get(route)
+        if not before:
+            continue
+        p95_change = stats['p95_ms']/before['p95_ms'] - 1 if before['p95_ms'] else 0
+        rps_change = stats['requests_per_second']/before['requests_per_second'] - 1 if before['requests_per_second'] else 0
+        print(f"{route:<10}{before['p95_ms']:>9.1f} -> {stats['p95_ms']:<7.1f}{p95_change:>+6.0%}"
+              f"{before['requests_per_second']:>9.1f} -> {stats['requests_per_second']:<7.1f}{rps_change:>+6.0%}")
+        if p95_change > tolerance or rps_change < -tolerance:
+            regressions.append(route)
+    return regressions
+
+
+
+'''Run'''
+
+async def serve(app):
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=0, log_level='warning', access_log=False))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()
+        await asyncio.sleep(0.05)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    return server, task, f'http://127.0.0.1:{port}'
+
+async def run(args, directory):
+    import httpx
+    configure_environment(args, directory)
+    main = await prepare_app(args)
+    documents = make_documents(args.documents, args.document_kb, args.seed)
+    images = await asyncio.to_thread(make_images, args.images, args.image_size, args.seed)
+
+    server, task, base_url = await serve(main.app)
+    recorder = Recorder()
+    stop = asyncio.Event()
+    run_id = uuid.uuid4().hex[:8]
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    try:
+        async with httpx.AsyncClient(base_url=base_url, timeout=None, limits=limits) as client:
+            users = [VirtualUser(number, run_id, client, recorder, args, documents, images) for number in range(args.concurrency)]
+            tasks = [asyncio.create_task(user.run(stop)) for user in users]
+            await asyncio.sleep(args.warmup)
+            recorder.recording = True
+            start = time.perf_counter()
+            await asyncio.sleep(args.duration)
+            recorder.recording = False
+            elapsed = time.perf_counter() - start
+            stop.set()
+            await asyncio.gather(*tasks)
+    finally:
+        server.should_exit = True
+        await task
+
+    routes, total = summarize(recorder, elapsed)
+    return {'created_at': datetime.now(timezone.utc).isoformat(),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'database': main.db.engine.dialect.name,
+            'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'database_url')},
+            'settings': {key: os.environ[key] for key in RECORDED_SETTINGS if key in os.environ},
+            'elapsed_seconds': elapsed,
+            'routes': routes,
+            'total': total}
+
+def main(argv=None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory() as directory:
+        results = asyncio.run(run(args, directory))
+    print_table(results)
+
+    output = args.output or os.path.join('benchmarks', 'results', f"{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as results_file:
+        json.dump(results, results_file, indent=2)
+    print(f'\nSaved results to {output}')
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        if regressions:
+            print(f"\nRegressed: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
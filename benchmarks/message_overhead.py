@@ -0,0 +1,110 @@
+'''Per-turn CPU overhead of the chat history representation, against history length.
+
+Times everything a chat turn does with the history apart from the model call: loading it from cached records,
+adding the new message, windowing the prompt, converting it to model messages and writing the new records back.
+The plain Message records are compared with the PromptTemplate based representation they replaced.
+
+    python -m benchmarks.message_overhead --lengths 10,50,200,1000
+'''
+
+import json
+import time
+import random
+import asyncio
+import argparse
+from langchain_core.prompts import SystemMessagePromptTemplate, HumanMessagePromptTemplate, AIMessagePromptTemplate, ChatPromptTemplate
+from models import base_model
+from models.context_manager import ContextWindow, estimate_tokens
+from benchmarks.fakes import fake_text
+
+TEXT = 'Explain how {placeholders} and } braces are handled in this message.'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Per-turn overhead of the chat history representation.')
+    parser.add_argument('--lengths', default='10,50,200,1000', help='History lengths to measure, in turns.')
+    parser.add_argument('--words', type=int, default=60, help='Words per message.')
+    parser.add_argument('--repeat', type=int, default=20, help='Turns timed per history length.')
+    parser.add_argument('--output', help='Where to save the results as JSON.')
+    return parser.parse_args(argv)
+
+def make_records(turns, words):
+    rng = random.Random(turns)
+    records = []
+    for turn in range(turns):
+        # Some braces, so the escaping cost of the template representation is included
+        records.append({'role':'user', 'content':fake_text(rng.random(), words) + ' {x}'})
+        records.append({'role':'assistant', 'content':fake_text(rng.random(), words) + ' {"a": 1}'})
+    return records
+
+
+
+'''PromptTemplate representation, as used before base_model.Message'''
+
+def escape(text):
+    return text.replace("{", "{{").replace("}", "}}")
+
+def template_text(message):
+    return message.prompt.template.replace("{{", "{").replace("}}", "}")
+
+def template_from_records(records):
+    chat_history = [SystemMessagePromptTemplate.from_template(base_model.AI_THEME)]
+    for record in records:
+        template = HumanMessagePromptTemplate if record['role'] == 'user' else AIMessagePromptTemplate
+        chat_history.append(template.from_template(escape(record['content'])))
+    return chat_history
+
+def template_turn(records, text):
+    chat_history = template_from_records(records)
+    turn_start = len(chat_history)
+    chat_history.append(HumanMessagePromptTemplate.from_template(escape(text)))
+    sizes = [estimate_tokens(template_text(message)) for message in chat_history[1:]]
+    ContextWindow(token_budget=10**9).window_start(sizes, estimate_tokens(template_text(chat_history[0])))
+    ChatPromptTemplate.from_messages(chat_history).format_messages()
+    chat_history.append(AIMessagePromptTemplate.from_template(escape('Reply')))
+    return [{'role':'user' if isinstance(message, HumanMessagePromptTemplate) else 'assistant', 'content':template_text(message)}
+            for message in chat_history[turn_start:]]
+
+
+
+'''Message representation'''
+
+async def message_turn(records, text):
+    chat_history = base_model.from_records(records)
+    turn_start = len(chat_history)
+    base_model.add_user_message(chat_history, text)
+    prompt = await base_model.abuild_prompt(chat_history, ContextWindow(token_budget=10**9))
+    base_model.to_model_messages(prompt)
+    base_model.add_ai_message(chat_history, 'Reply')
+    return base_model.to_records(chat_history[turn_start:])
+
+
+
+async def measure(turns, args):
+    records = make_records(turns, args.words)
+    timings = {}
+    for name, turn in (('templates', template_turn), ('messages', message_turn)):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            result = turn(records, TEXT)
+            if asyncio.iscoroutine(result):
+                await result
+        timings[name] = (time.perf_counter() - start)/args.repeat*1000
+    return {'turns': turns, 'templates_ms': timings['templates'], 'messages_ms': timings['messages'],
+            'speedup': timings['templates']/timings['messages']}
+
+async def run(args):
+    return [await measure(int(turns), args) for turns in args.lengths.split(',')]
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = asyncio.run(run(args))
+    print(f"{'turns':>8}{'templates ms':>15}{'messages ms':>14}{'speedup':>10}")
+    for row in results:
+        print(f"{row['turns']:>8}{row['templates_ms']:>15.3f}{row['messages_ms']:>14.3f}{row['speedup']:>9.1f}x")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as results_file:
+            json.dump({'words': args.words, 'repeat': args.repeat, 'results': results}, results_file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -1,41 +1,185 @@
 import os
 from dotenv import load_dotenv
-import pickle
+import json
+import asyncio
+import time
 from redis.asyncio import Redis
+import metrics
+
+CHAT_HISTORY_TTL = 1800
+SESSION_LIST_TTL = 300
+RESPONSE_INDEX_KEY = 'resp:index'
+
+session_cache_requests = metrics.Counter('assistant_session_cache_requests_total', 'Chat history and document chunk lookups in Redis.', ['kind', 'result'])
 
 class Cache:
     def __init__(self):
         load_dotenv()
         redis_url = os.getenv("REDIS_URL")
         self.client = Redis.from_url(redis_url)
+        self.pending_loads = {}
+
+    @staticmethod
+    def chat_key(session_id):
+        return f"chat:{session_id}"
+
+    async def store_chat_history(self, session_id, records):
+        # Replaces the whole history, used when a session is (re)loaded from the database
+        key = self.chat_key(session_id)
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.delete(key)
+            if records:
+                pipe.rpush(key, *[json.dumps(record) for record in records])
+            pipe.expire(key, CHAT_HISTORY_TTL)
+            await pipe.execute()
+
+    async def append_chat_history(self, session_id, records, context=None, chunks=None):
+        # Only the messages of the current turn are sent, so the cost per turn does not grow with the session.
+        # The context state and document chunks of the turn go in the same round trip when given
+        key = self.chat_key(session_id)
+        documents_key = self.documents_key(session_id)
+        async with self.client.pipeline(transaction=True) as pipe:
+            if records:
+                pipe.rpush(key, *[json.dumps(record) for record in records])
+            pipe.expire(key, CHAT_HISTORY_TTL)
+            if context is not None:
+                pipe.hset(self.context_key(session_id), mapping=context)
+                pipe.expire(self.context_key(session_id), CHAT_HISTORY_TTL)
+            if chunks is not None:
+                pipe.hset(documents_key, mapping={'count': len(chunks), 'chunks': json.dumps(chunks)})
+            pipe.expire(documents_key, CHAT_HISTORY_TTL)
+            await pipe.execute()
+
+    @staticmethod
+    def documents_key(session_id):
+        return f"docs:{session_id}"
+
+    async def store_document_chunks(self, session_id, chunks):
+        key = self.documents_key(session_id)
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping={'count': len(chunks), 'chunks': json.dumps(chunks)})
+            pipe.expire(key, CHAT_HISTORY_TTL)
+            await pipe.execute()
+
+    async def get_document_count(self, session_id):
+        count = await self.client.hget(self.documents_key(session_id), 'count')
+        return None if count is None else int(count)
+
+    async def get_document_chunks(self, session_id, loader=None):
+        serialized_data = await self.client.hget(self.documents_key(session_id), 'chunks')
+        session_cache_requests.inc(kind='documents', result='miss' if serialized_data is None else 'hit')
+        if serialized_data is not None or loader is None:
+            return json.loads(serialized_data) if serialized_data else []
+        return await self.single_flight(self.documents_key(session_id), lambda: self._load_document_chunks(session_id, loader))
+
+    async def _load_document_chunks(self, session_id, loader):
+        chunks = await loader(session_id)
+        await self.store_document_chunks(session_id, chunks)
+        return chunks
+
+    @staticmethod
+    def context_key(session_id):
+        return f"context:{session_id}"
+
+    async def get_context(self, session_id):
+        data = await self.client.hgetall(self.context_key(session_id))
+        return {key.decode(): value.decode() for key, value in data.items()}
+
+    async def delete_sessions(self, session_ids):
+        keys = [key(session_id) for session_id in session_ids for key in (self.chat_key, self.context_key, self.documents_key)]
+        if keys:
+            await self.client.delete(*keys)
+
+    @staticmethod
+    def session_list_key(user_id):
+        return f"sessions:{user_id}"
+
+    async def get_session_list(self, user_id):
+        serialized_data = await self.client.get(self.session_list_key(user_id))
+        return None if serialized_data is None else json.loads(serialized_data)
+
+    async def store_session_list(self, user_id, sessions):
+        await self.client.set(self.session_list_key(user_id), json.dumps(sessions), ex=SESSION_LIST_TTL)
+
+    async def delete_session_list(self, user_id):
+        await self.client.delete(self.session_list_key(user_id))
+
+    @staticmethod
+    def response_key(key):
+        return f"resp:{key}"
+
+    async def get_response(self, key):
+        response = await self.client.get(self.response_key(key))
+        return None if response is None else response.decode()
+
+    async def store_response(self, key, response, ttl, max_entries):
+        # A sorted set of write times bounds the number of cached responses
+        now = time.time()
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.set(self.response_key(key), response, ex=ttl)
+            pipe.zadd(RESPONSE_INDEX_KEY, {key: now})
+            pipe.zremrangebyscore(RESPONSE_INDEX_KEY, 0, now - ttl)
+            pipe.zcard(RESPONSE_INDEX_KEY)
+            results = await pipe.execute()
+        excess = results[-1] - max_entries
+        if excess > 0:
+            stale = await self.client.zrange(RESPONSE_INDEX_KEY, 0, excess - 1)
+            if stale:
+                async with self.client.pipeline(transaction=False) as pipe:
+                    pipe.delete(*[self.response_key(stale_key.decode()) for stale_key in stale])
+                    pipe.zrem(RESPONSE_INDEX_KEY, *stale)
+                    await pipe.execute()
+
+    async def get_chat_history(self, session_id, last_n=None, loader=None):
+        start = -last_n if last_n else 0
+        with metrics.span('chat_history'):
+            # The TTL is refreshed in the same transaction as the read, so the list cannot expire between this read
+            # and the append at the end of the turn, which would leave a list holding only that turn
+            async with self.client.pipeline(transaction=True) as pipe:
+                pipe.lrange(self.chat_key(session_id), start, -1)
+                pipe.expire(self.chat_key(session_id), CHAT_HISTORY_TTL)
+                pipe.expire(self.context_key(session_id), CHAT_HISTORY_TTL)
+                serialized_data, *_ = await pipe.execute()
+            if serialized_data or loader is None:
+                session_cache_requests.inc(kind='chat_history', result='hit' if serialized_data else 'miss')
+                records = [json.loads(record) for record in serialized_data]
+                return records
+            # Cache miss (expired or flushed): rebuild from the source of truth and repopulate Redis
+            session_cache_requests.inc(kind='chat_history', result='miss')
+            records = await self.reload_chat_history(session_id, loader)
+            return records[start:]
+
+    async def reload_chat_history(self, session_id, loader):
+        return await self.single_flight(self.chat_key(session_id), lambda: self._load_chat_history(session_id, loader))
 
-    async def store_chat_history(self, session_id, chat_history):
-        session_id = str(session_id)
-        serialized_data = pickle.dumps(chat_history)
-        await self.client.set(session_id, serialized_data, ex=1800)
+    async def single_flight(self, key, load):
+        # Concurrent misses on the same key share a single load
+        task = self.pending_loads.get(key)
+        if task is None:
+            task = asyncio.ensure_future(load())
+            self.pending_loads[key] = task
+            task.add_done_callback(lambda _: self.pending_loads.pop(key, None))
+        return await asyncio.shield(task)
 
-    async def get_chat_history(self, session_id):
-        session_id = str(session_id)
-        serialized_data = await self.client.get(session_id)
-        chat_history = pickle.loads(serialized_data)
-        return chat_history
+    async def _load_chat_history(self, session_id, loader):
+        records = await loader(session_id)
+        await self.store_chat_history(session_id, records)
+        return records
         
 
 if __name__ == '__main__':
-    import asyncio
     import uuid
-    from models.base_model import chat, create_chat_history
+    from models.base_model import achat, from_records, to_records
 
     async def main():
         r = Cache()
         session_id = uuid.uuid4()
-        chat_history = create_chat_history()
-        await r.store_chat_history(session_id, chat_history)
         while True:
-            chat_history = await r.get_chat_history(session_id)
+            chat_history = from_records(await r.get_chat_history(session_id))
+            turn_start = len(chat_history)
             text = input('User: ')
-            chat_history, response = chat(chat_history, text)
-            await r.store_chat_history(session_id, chat_history)
+            response = await achat(chat_history, text)
+            await r.append_chat_history(session_id, to_records(chat_history[turn_start:]))
             print(f"\nAI: {response}\n")
 
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
@@ -1,14 +1,57 @@
 import os
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, MetaData, Table, Column, ForeignKey, String, JSON, select, insert, delete
+from sqlalchemy import MetaData, Table, Column, ForeignKey, Index, Identity, String, Text, JSON, Integer, BigInteger, DateTime, select, insert, update, delete, func, tuple_, text, bindparam
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.dialects.postgresql import UUID
 
+SYNC_POSTGRES_DRIVERS = ('postgres', 'postgresql', 'postgresql+psycopg2')
+
+# Brings tables created before the ordering columns and indexes existed up to the current schema (idempotent)
+POSTGRES_MIGRATIONS = (
+    "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT now()",
+    "ALTER TABLE chats ADD COLUMN IF NOT EXISTS seq BIGSERIAL",
+    "ALTER TABLE chats ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT now()",
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT now()",
+    "CREATE INDEX IF NOT EXISTS ix_sessions_user_id_created_at ON sessions (user_id, created_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_chats_session_id_seq ON chats (session_id, seq)",
+    "CREATE INDEX IF NOT EXISTS ix_documents_session_id ON documents (session_id)",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMPTZ",
+    "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMPTZ",
+    "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS summary TEXT",
+    "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS summarized INTEGER NOT NULL DEFAULT 0",
+) + tuple(
+    f"""DO $$ BEGIN
+    IF EXISTS (SELECT 1 FROM pg_constraint WHERE conname = '{table}_{column}_fkey' AND confdeltype <> 'c') THEN
+        ALTER TABLE {table} DROP CONSTRAINT {table}_{column}_fkey;
+        ALTER TABLE {table} ADD CONSTRAINT {table}_{column}_fkey FOREIGN KEY ({column}) REFERENCES {parent} (id) ON DELETE CASCADE;
+    END IF;
+    END $$"""
+    for table, column, parent in (('sessions', 'user_id', 'users'), ('chats', 'session_id', 'sessions'), ('documents', 'session_id', 'sessions'))
+)
+
+PURGE_BATCH_SIZE = int(os.getenv('PURGE_BATCH_SIZE', 1000))
+
+def async_database_url(database_url):
+    url = make_url(database_url)
+    if url.drivername in SYNC_POSTGRES_DRIVERS:
+        url = url.set(drivername='postgresql+asyncpg')
+    return url
+
 class Database:
     def __init__(self):
         load_dotenv()
         database_url = os.getenv('DATABASE_URL')
-        self.engine = create_engine(database_url, echo=True)
-        self.conn = self.engine.connect()
+        # Each query checks a connection out of the pool for the duration of its own transaction
+        self.engine = create_async_engine(
+            async_database_url(database_url),
+            echo=os.getenv('DB_ECHO', 'false').lower() == 'true',
+            pool_size=int(os.getenv('DB_POOL_SIZE', 10)),
+            max_overflow=int(os.getenv('DB_MAX_OVERFLOW', 20)),
+            pool_timeout=float(os.getenv('DB_POOL_TIMEOUT', 30)),
+            pool_recycle=int(os.getenv('DB_POOL_RECYCLE', 1800)),
+            pool_pre_ping=True
+        )
 
         self.metadata = MetaData()
 
@@ -17,165 +60,211 @@ class Database:
             Column('id', UUID(as_uuid=True), primary_key=True),
             Column('username', String, unique=True, nullable=False),
             Column('email', String, unique=True, nullable=False),
-            Column('hashed_password', String, nullable=False)
+            Column('hashed_password', String, nullable=False),
+            Column('deleted_at', DateTime(timezone=True))   #Set when the account is marked for purging
         )
 
         self.sessions_table = Table(
             'sessions', self.metadata,
             Column('id', UUID(as_uuid=True), primary_key=True),
             Column('name', String),
-            Column('user_id', UUID(as_uuid=True), ForeignKey('users.id'), nullable=False)
+            Column('user_id', UUID(as_uuid=True), ForeignKey('users.id', ondelete='CASCADE'), nullable=False),
+            Column('created_at', DateTime(timezone=True), server_default=func.now(), nullable=False),
+            Column('deleted_at', DateTime(timezone=True)),
+            Column('summary', Text),   #Rolling summary of the older turns, kept after the cached context expires
+            Column('summarized', Integer, server_default='0', nullable=False),   #Messages folded into the summary
+            Index('ix_sessions_user_id_created_at', 'user_id', 'created_at', 'id')
         )
 
         self.chats_table = Table(
             'chats', self.metadata,
             Column('id', UUID(as_uuid=True), primary_key=True),
             Column('conversation', JSON),
-            Column('session_id',  UUID(as_uuid=True), ForeignKey('sessions.id'), nullable=False)
+            Column('session_id',  UUID(as_uuid=True), ForeignKey('sessions.id', ondelete='CASCADE'), nullable=False),
+            Column('seq', BigInteger, Identity()),   #Monotonic insertion order
+            Column('created_at', DateTime(timezone=True), server_default=func.now(), nullable=False),
+            Index('ix_chats_session_id_seq', 'session_id', 'seq')
         )
 
-    def create_tables(self):
-        self.metadata.create_all(self.engine)
+        self.documents_table = Table(
+            'documents', self.metadata,
+            Column('id', UUID(as_uuid=True), primary_key=True),
+            Column('name', String),
+            Column('chunks', JSON),
+            Column('session_id',  UUID(as_uuid=True), ForeignKey('sessions.id', ondelete='CASCADE'), nullable=False),
+            Column('created_at', DateTime(timezone=True), server_default=func.now(), nullable=False),
+            Index('ix_documents_session_id', 'session_id')
+        )
+
+    async def create_tables(self):
+        async with self.engine.begin() as conn:
+            await conn.run_sync(self.metadata.create_all)
     
-    def delete_tables(self):
-        self.metadata.drop_all(self.engine)
+    async def migrate(self):
+        await self.create_tables()
+        if self.engine.dialect.name == 'postgresql':
+            async with self.engine.begin() as conn:
+                for statement in POSTGRES_MIGRATIONS:
+                    await conn.execute(text(statement))
+    
+    async def delete_tables(self):
+        async with self.engine.begin() as conn:
+            await conn.run_sync(self.metadata.drop_all)
+
+    async def close(self):
+        await self.engine.dispose()
 
     '''User related queries'''
 
-    def insert_user(self, id, name, email, hashed_pwd):
-        conn = self.conn
-        trans = conn.begin()
-        try:
+    async def insert_user(self, id, name, email, hashed_pwd):
+        async with self.engine.begin() as conn:
             query = insert(self.users_table).values(id=id, username=name, email=email, hashed_password=hashed_pwd)
-            conn.execute(query)
-            trans.commit()
-        except Exception as e:
-            trans.rollback()
-            raise e
-
-
-    def select_user_by_username(self, username):
-        conn = self.conn
-        trans = conn.begin()
-        try:
-            query = select(self.users_table).where(self.users_table.c.username == username)
-            result = conn.execute(query)
-            trans.commit()
+            await conn.execute(query)
+
+
+    async def select_user_by_username(self, username):
+        async with self.engine.begin() as conn:
+            query = select(self.users_table).where(self.users_table.c.username == username, self.users_table.c.deleted_at.is_(None))
+            result = await conn.execute(query)
             return result.fetchone()
-        except Exception as e:
-            trans.rollback()
-            raise e
     
 
-    def select_user_by_email(self, email):
-        conn = self.conn
-        trans = conn.begin()
-        try:
-            query = select(self.users_table).where(self.users_table.c.email == email)
-            result = conn.execute(query)
-            trans.commit()
+    async def select_user_by_email(self, email):
+        async with self.engine.begin() as conn:
+            query = select(self.users_table).where(self.users_table.c.email == email, self.users_table.c.deleted_at.is_(None))
+            result = await conn.execute(query)
             return result.fetchone()
-        except Exception as e:
-            trans.rollback()
-            raise e
     
 
-    def remove_user(self, user_id):
-        sessions = self.get_sessions(user_id)
-        session_ids = [session[0] for session in sessions]
-        conn = self.conn
-        trans = conn.begin()
-        try:
-            for session_id in session_ids:
-                chat_query = delete(self.chats_table).where(self.chats_table.c.session_id == session_id)
-                conn.execute(chat_query)
-            session_query = delete(self.sessions_table).where(self.sessions_table.c.user_id == user_id)
-            conn.execute(session_query)
+    async def mark_user_deleted(self, user_id):
+        # Hides the account and its sessions right away; purge_user removes the rows later
+        async with self.engine.begin() as conn:
+            user_query = update(self.users_table).where(self.users_table.c.id == user_id).values(deleted_at=func.now())
+            await conn.execute(user_query)
+            session_query = update(self.sessions_table).where(self.sessions_table.c.user_id == user_id).values(deleted_at=func.now()).returning(self.sessions_table.c.id)
+            result = await conn.execute(session_query)
+            return [row[0] for row in result.fetchall()]
+
+
+    async def purge_user(self, user_id, batch_size=PURGE_BATCH_SIZE):
+        user_sessions = select(self.sessions_table.c.id).where(self.sessions_table.c.user_id == user_id)
+        await self.delete_in_batches(self.chats_table, self.chats_table.c.session_id.in_(user_sessions), batch_size)
+        await self.delete_in_batches(self.documents_table, self.documents_table.c.session_id.in_(user_sessions), batch_size)
+        await self.delete_in_batches(self.sessions_table, self.sessions_table.c.user_id == user_id, batch_size)
+        async with self.engine.begin() as conn:
             user_query = delete(self.users_table).where(self.users_table.c.id == user_id)
-            conn.execute(user_query)
-            trans.commit()
-        except Exception as e:
-            trans.rollback()
-            raise e
+            await conn.execute(user_query)
+
+
+    async def select_deleted_users(self):
+        async with self.engine.begin() as conn:
+            query = select(self.users_table.c.id).where(self.users_table.c.deleted_at.is_not(None))
+            result = await conn.execute(query)
+            return [row[0] for row in result.fetchall()]
+
+
+    async def delete_in_batches(self, table, condition, batch_size):
+        # Each batch is its own short transaction so a large purge never holds long locks
+        while True:
+            batch = select(table.c.id).where(condition).limit(batch_size).scalar_subquery()
+            async with self.engine.begin() as conn:
+                result = await conn.execute(delete(table).where(table.c.id.in_(batch)))
+            if result.rowcount < batch_size:
+                break
 
 
     '''Session related queries'''
 
-    def insert_session(self, id, title, user_id):
-        conn = self.conn
-        trans = conn.begin()
-        try:
-            query = insert(self.sessions_table).values(id=id, name=title, user_id=user_id)
-            conn.execute(query)
-            trans.commit()
-        except Exception as e:
-            trans.rollback()
-            raise e
-
-
-    def get_sessions(self, user_id):
-        conn = self.conn
-        trans = conn.begin()
-        try:
-            query = select(self.sessions_table).where(self.sessions_table.c.user_id == user_id)
-            result = conn.execute(query)
-            trans.commit()
+    async def update_session_title(self, session_id, title):
+        async with self.engine.begin() as conn:
+            query = update(self.sessions_table).where(self.sessions_table.c.id == session_id).values(name=title)
+            await conn.execute(query)
+
+
+    async def get_session_page(self, user_id, limit, cursor=None):
+        # Newest first; the cursor is the (created_at, id) of the last session on the previous page
+        async with self.engine.begin() as conn:
+            table = self.sessions_table
+            query = select(table.c.id, table.c.name, table.c.created_at).where(table.c.user_id == user_id, table.c.deleted_at.is_(None))
+            if cursor:
+                query = query.where(tuple_(table.c.created_at, table.c.id) < tuple_(*cursor))
+            query = query.order_by(table.c.created_at.desc(), table.c.id.desc()).limit(limit + 1)
+            result = await conn.execute(query)
             sessions = result.fetchall()
-            return sessions
-        except Exception as e:
-            trans.rollback()
-            raise e
+            next_cursor = None
+            if len(sessions) > limit:
+                sessions = sessions[:limit]
+                next_cursor = (sessions[-1][2], sessions[-1][0])
+            return sessions, next_cursor
     
 
-    def get_session_title(self, session_id):
-        conn = self.conn
-        trans = conn.begin()
-        try:
+    async def get_session_owner(self, session_id):
+        async with self.engine.begin() as conn:
+            query = select(self.sessions_table.c.user_id).where(self.sessions_table.c.id == session_id, self.sessions_table.c.deleted_at.is_(None))
+            result = await conn.execute(query)
+            owner = result.fetchone()
+            return owner[0] if owner else None
+    
+
+    async def get_session_title(self, session_id):
+        async with self.engine.begin() as conn:
             query = select(self.sessions_table.c.name).where(self.sessions_table.c.id == session_id)
-            result = conn.execute(query)
-            trans.commit()
+            result = await conn.execute(query)
             title = result.fetchone()
-            return title[0]
-        except Exception as e:
-            trans.rollback()
-            raise e
-
-
-    def delete_session(self, session_id):
-        conn = self.conn
-        trans = conn.begin()
-        try:
-            chat_query = delete(self.chats_table).where(self.chats_table.c.session_id == session_id)
-            conn.execute(chat_query)
+            return title[0] if title else None
+
+
+    async def get_session_context(self, session_id):
+        async with self.engine.begin() as conn:
+            query = select(self.sessions_table.c.summary, self.sessions_table.c.summarized).where(self.sessions_table.c.id == session_id)
+            result = await conn.execute(query)
+            context = result.fetchone()
+            return {'summary':context[0] or '', 'summarized':context[1]} if context else {}
+
+
+    async def mark_session_deleted(self, session_id):
+        async with self.engine.begin() as conn:
+            query = update(self.sessions_table).where(self.sessions_table.c.id == session_id).values(deleted_at=func.now())
+            await conn.execute(query)
+
+
+    async def purge_session(self, session_id, batch_size=PURGE_BATCH_SIZE):
+        await self.delete_in_batches(self.chats_table, self.chats_table.c.session_id == session_id, batch_size)
+        await self.delete_in_batches(self.documents_table, self.documents_table.c.session_id == session_id, batch_size)
+        async with self.engine.begin() as conn:
             session_query = delete(self.sessions_table).where(self.sessions_table.c.id == session_id)
-            conn.execute(session_query)
-            trans.commit()
-        except Exception as e:
-            trans.rollback()
-            raise e
+            await conn.execute(session_query)
+
+
+    async def select_deleted_sessions(self):
+        async with self.engine.begin() as conn:
+            query = select(self.sessions_table.c.id).where(self.sessions_table.c.deleted_at.is_not(None))
+            result = await conn.execute(query)
+            return [row[0] for row in result.fetchall()]
 
 
     '''Chat related queries'''
 
-    def insert_chat(self, id, new_conversation, session_id):
-        conn = self.conn
-        trans = conn.begin()
-        try:
-            query = insert(self.chats_table).values(id=id, conversation=new_conversation, session_id=session_id)
-            conn.execute(query)
-            trans.commit()
-        except Exception as e:
-            trans.rollback()
-            raise e
-
-
-    def select_chats(self, session_id):
-        conn = self.conn
-        trans = conn.begin()
-        try:
-            query = select(self.chats_table).where(self.chats_table.c.session_id == session_id)
-            result = conn.execute(query)
-            trans.commit()
+    async def save_turns(self, sessions, documents, chats, contexts=()):
+        # Rows of one or more chat turns are written in a single transaction, with one multi-row insert per table.
+        # contexts hold {'session_id', 'summary', 'summarized'} for sessions whose rolling summary moved on
+        async with self.engine.begin() as conn:
+            if sessions:
+                await conn.execute(insert(self.sessions_table), sessions)
+            if contexts:
+                table = self.sessions_table
+                query = update(table).where(table.c.id == bindparam('session_id')).values(summary=bindparam('context_summary'), summarized=bindparam('context_summarized'))
+                await conn.execute(query, [{'session_id':context['session_id'], 'context_summary':context['summary'], 'context_summarized':context['summarized']} for context in contexts])
+            if documents:
+                await conn.execute(insert(self.documents_table), documents)
+            if chats:
+                await conn.execute(insert(self.chats_table), chats)
+
+
+    async def select_chats(self, session_id):
+        async with self.engine.begin() as conn:
+            query = select(self.chats_table).where(self.chats_table.c.session_id == session_id).order_by(self.chats_table.c.seq)
+            result = await conn.execute(query)
             rows = result.fetchall()
             conversation_list=[]
             if not rows:
@@ -183,9 +272,37 @@ class Database:
             for row in rows:
                 conversation_list.append(row[1])
             return conversation_list
-        except Exception as e:
-            trans.rollback()
-            raise e
+
+
+    async def select_chat_page(self, session_id, limit, cursor=None):
+        # Latest chats first, returned oldest to newest; the cursor is the seq of the oldest chat on the previous page
+        async with self.engine.begin() as conn:
+            table = self.chats_table
+            query = select(table.c.conversation, table.c.seq).where(table.c.session_id == session_id)
+            if cursor is not None:
+                query = query.where(table.c.seq < cursor)
+            query = query.order_by(table.c.seq.desc()).limit(limit + 1)
+            result = await conn.execute(query)
+            rows = result.fetchall()
+            next_cursor = None
+            if len(rows) > limit:
+                rows = rows[:limit]
+                next_cursor = rows[-1][1]
+            conversation_list = [row[0] for row in reversed(rows)]
+            return conversation_list, next_cursor
+
+
+    '''Document related queries'''
+
+    async def select_document_chunks(self, session_id):
+        async with self.engine.begin() as conn:
+            query = select(self.documents_table.c.chunks).where(self.documents_table.c.session_id == session_id).order_by(self.documents_table.c.created_at)
+            result = await conn.execute(query)
+            rows = result.fetchall()
+            chunks=[]
+            for row in rows:
+                chunks.extend(row[0])
+            return chunks
 
 
 if __name__ == '__main__':
@@ -1,16 +1,30 @@
 import os
+import json
 from models import base_model, image_model
 from models.document_loader import DocumentLoader
+from models.context_manager import ContextWindow
+from models.retriever import BM25Index, IndexCache, split_document, RETRIEVAL_TOP_K
 from database import Database
 from cache import Cache
-from auth_service import User, Token, AccessToken, TokenData, get_user, authenticate_user, create_token, get_password_hash, current_user
-from langchain_core.prompts import HumanMessagePromptTemplate, AIMessagePromptTemplate
-from typing import Optional
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Depends, status
+import metrics
+import response_cache
+from uploads import read_upload, UploadSizeLimit
+from turn_writer import Turn, TurnWriter
+from admission import AdmissionLimiter
+from auth_service import User, Token, AccessToken, TokenData, TTLCache, get_user, invalidate_user, authenticate_user, token_claims, create_token, aget_password_hash, current_user, authorized_user
+from typing import Optional, Union, Annotated
+from fastapi import FastAPI, File, UploadFile, Form, Query, HTTPException, Depends, BackgroundTasks, Response, status
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, PlainTextResponse
 import uvicorn
 import uuid
+import base64
+from datetime import datetime
+import asyncio
+import weakref
+import logging
+from contextlib import asynccontextmanager
 
 ACCESS_TOKEN_EXPIRES_MINUTES = 1
 REFRESH_TOKEN_EXPIRES_MINUTES = 2880    #2days
@@ -18,243 +32,477 @@ MAX_FILE_SIZE = 5242880   #5MB
 ROLE1 = 'User'
 ROLE2 = 'Assistant'
 TITLE_QUERY = 'Generate a title for this chat in under 7 words.'
+PLACEHOLDER_TITLE = 'New Chat'
+SESSION_OWNER_TTL = 3600
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+logger = logging.getLogger(__name__)
+
+session_list_requests = metrics.Counter('assistant_session_list_cache_requests_total', 'Session list lookups served from the cache or the database.', ['result'])
 
 db=Database()
 
 r = Cache()
 
+writer = TurnWriter(db)
+
+limiter = AdmissionLimiter()
+
 dm = DocumentLoader()
 
-app=FastAPI()
+indexes = IndexCache()
+
+session_owners = TTLCache(ttl=SESSION_OWNER_TTL)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    sweep = asyncio.create_task(purge_marked())
+    yield
+    sweep.cancel()
+    await writer.close()
+    dm.close()
+    image_model.preprocessor.close()
+    await db.close()
+
+app=FastAPI(lifespan=lifespan)
+
+app.add_middleware(UploadSizeLimit, max_size=MAX_FILE_SIZE, paths=['/document/', '/image/'])
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  
     allow_credentials=True,
     allow_methods=["*"],  
-    allow_headers=["*"]
+    allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"]
 )
 
+app.add_middleware(metrics.RequestTiming)
+
 '''Authentication Routes'''
 
 @app.post("/register/")
 async def register_user(username: str = Form(), email: str = Form(), password: str = Form()):
     try:
-        if db.select_user_by_username(username):
+        if await db.select_user_by_username(username):
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Username already exists.")
-        if db.select_user_by_email(email):
+        if await db.select_user_by_email(email):
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered.")
-        hashed_password = get_password_hash(password)
-        db.insert_user(uuid.uuid4(), username, email, hashed_password)
+        hashed_password = await aget_password_hash(password)
+        await db.insert_user(uuid.uuid4(), username, email, hashed_password)
         return {"message": "User created successfully."}
     except Exception as e:
         return {'Error':str(e)}
 
 @app.post("/login/", response_model=Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = authenticate_user(db, form_data.username, form_data.password)
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, 
                             detail="Incorrect username or password",
                             headers={"WWW-Authenticate": "Bearer"})
-    access_token = create_token(data={'sub':user.username}, expires_delta=ACCESS_TOKEN_EXPIRES_MINUTES)
-    refresh_token = create_token(data={'sub':user.username}, expires_delta=REFRESH_TOKEN_EXPIRES_MINUTES, refresh=True)
+    access_token = create_token(data=token_claims(user), expires_delta=ACCESS_TOKEN_EXPIRES_MINUTES)
+    refresh_token = create_token(data=token_claims(user), expires_delta=REFRESH_TOKEN_EXPIRES_MINUTES, refresh=True)
     return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token}
 
 @app.post("/token/", response_model=AccessToken)
 async def login_for_access_token(refresh_token: str = Form()):
     token_data = await current_user(refresh_token)
-    user = get_user(db, token_data.username)
+    user = await get_user(db, token_data.username) if token_data.refresh else None
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, 
                             detail="Invalid User",
                             headers={"WWW-Authenticate": "Bearer"})
-    access_token = create_token(data={'sub':user.username}, expires_delta=ACCESS_TOKEN_EXPIRES_MINUTES)
+    access_token = create_token(data=token_claims(user), expires_delta=ACCESS_TOKEN_EXPIRES_MINUTES)
     return {"access_token": access_token, "token_type": "bearer"}
 
 
 '''Authorized Routes'''
 
+def session_uuid(session_id: str):
+    # The path's session id as a UUID, parsed once per request; None if it is not one
+    if session_id == 'new':
+        return session_id
+    try:
+        return uuid.UUID(session_id)
+    except ValueError:
+        return None
+
+SessionId = Annotated[Union[uuid.UUID, str], Depends(session_uuid)]
+
+async def session_owner(session_id: SessionId, current_user: TokenData = Depends(authorized_user)):
+    # Session ids never change owner, so the owner is cached after one primary key lookup
+    if session_id != 'new':
+        owner = None
+        if session_id is not None:
+            with metrics.span('session_owner'):
+                owner = session_owners.get(str(session_id)) or await db.get_session_owner(session_id)
+        if owner != current_user.id:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Session not found.")
+        session_owners.put(str(session_id), owner)
+    return current_user
+
 @app.get("/user/", response_model = User)
-async def read_users_me(current_user: TokenData = Depends(current_user)):
-    user = get_user(db, current_user.username)
-    return user
+async def read_users_me(current_user: TokenData = Depends(authorized_user)):
+    if current_user.email is None:
+        return await get_user(db, current_user.username)
+    return User(id=current_user.id, username=current_user.username, email=current_user.email)
 
 @app.delete('/user/del/')
-async def delete_account(current_user: TokenData = Depends(current_user)):
+async def delete_account(background_tasks: BackgroundTasks, current_user: TokenData = Depends(authorized_user)):
     try:
-        user = get_user(db, current_user.username)
-        db.remove_user(user.id)
+        session_ids = await db.mark_user_deleted(current_user.id)
+        invalidate_user(current_user.username)
+        await r.delete_session_list(current_user.id)
+        await forget_sessions(session_ids)
+        background_tasks.add_task(purge_user, current_user.id)
     except Exception as e:
         return {'Error':str(e)}
     return {'message':'Account deleted successfully.'}
 
+def encode_session_cursor(cursor):
+    created_at, session_id = cursor
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{session_id}".encode()).decode()
+
+def decode_session_cursor(cursor):
+    try:
+        created_at, session_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), uuid.UUID(session_id)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor.")
+
 @app.get('/user/chats/')
-async def get_sessions(current_user: TokenData = Depends(current_user)):
+async def get_sessions(response: Response, 
+                       limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), 
+                       cursor: Optional[str] = None, 
+                       current_user: TokenData = Depends(authorized_user)):
+    # Newest sessions first; the cursor for older sessions is returned in the X-Next-Cursor header
+    position = decode_session_cursor(cursor) if cursor else None
     try:
-        user = get_user(db, current_user.username)
-        sessions = db.get_sessions(user.id)
+        if position is None:
+            sessions, next_cursor = await load_session_list(current_user.id, limit)
+        else:
+            sessions, next_cursor = await db.get_session_page(current_user.id, limit, position)
         session_dict = {}
         for session in sessions:
             session_dict[session[0]] = session[1]
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = encode_session_cursor(next_cursor)
         return session_dict
     except Exception as e:
         return {'Error':str(e)}
 
+async def load_session_list(user_id, limit):
+    # The newest MAX_PAGE_SIZE sessions of a user are cached, so the first page of any size skips the database
+    cached = await r.get_session_list(user_id)
+    session_list_requests.inc(result='miss' if cached is None else 'hit')
+    if cached is None:
+        sessions, next_cursor = await db.get_session_page(user_id, MAX_PAGE_SIZE)
+        cached = {'sessions':[[str(id), name, created_at.isoformat()] for id, name, created_at in sessions],
+                  'next_cursor':[next_cursor[0].isoformat(), str(next_cursor[1])] if next_cursor else None}
+        await r.store_session_list(user_id, cached)
+    sessions = [(uuid.UUID(id), name, datetime.fromisoformat(created_at)) for id, name, created_at in cached['sessions']]
+    if len(sessions) > limit:
+        return sessions[:limit], (sessions[limit-1][2], sessions[limit-1][0])
+    next_cursor = cached['next_cursor']
+    return sessions, (datetime.fromisoformat(next_cursor[0]), uuid.UUID(next_cursor[1])) if next_cursor else None
+
 @app.get('/user/chats/{session_id}/')
-async def get_chats(session_id: str, current_user: TokenData = Depends(current_user)):
-    # global current_session_history
+async def get_chats(session_id: SessionId, 
+                    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), 
+                    cursor: Optional[int] = None, 
+                    current_user: TokenData = Depends(session_owner)):
+    # Latest chats first page by page, each page in chronological order; pass next_cursor to load older chats.
+    # The chat history cache is read-through, so it is not re-warmed here.
+    try:
+        chats, next_cursor = await db.select_chat_page(session_id, limit, cursor)
+        title = await db.get_session_title(session_id)
+    except Exception as e:
+        return {'Error':str(e)}
+    return {'chats':chats, 'session_id':session_id, 'session_title':title, 'next_cursor':next_cursor}
+
+@app.get('/user/chats/{session_id}/title/')
+async def get_title(session_id: SessionId, current_user: TokenData = Depends(session_owner)):
+    try:
+        title = await db.get_session_title(session_id)
+    except Exception as e:
+        return {'Error':str(e)}
+    return {'session_id':session_id, 'session_title':title}
+
+@app.get('/user/chats/{session_id}/context/')
+async def get_context_stats(session_id: SessionId, current_user: TokenData = Depends(session_owner)):
     try:
-        chats = db.select_chats(session_id)
-        title = db.get_session_title(session_id)
-        chat_history = base_model.load_chat_history(chats, ROLE1, ROLE2)
-        # current_session_history = {user.id:chat_history}
-        await r.store_chat_history(session_id, chat_history)
+        context = ContextWindow.from_state(await r.get_context(session_id))
     except Exception as e:
         return {'Error':str(e)}
-    return {'chats':chats, 'session_id':session_id, 'session_title':title}
+    return {'session_id':session_id, **context.stats()}
+
+@app.get('/metrics')
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 @app.delete('/user/chats/{session_id}/del/')
-async def delete_session(session_id: str, current_user: TokenData = Depends(current_user)):
+async def delete_session(session_id: SessionId, background_tasks: BackgroundTasks, current_user: TokenData = Depends(session_owner)):
     try:
-        db.delete_session(session_id)
+        await db.mark_session_deleted(session_id)
+        await r.delete_session_list(current_user.id)
+        await forget_sessions([session_id])
+        background_tasks.add_task(purge_session, session_id)
     except Exception as e:
         return {'Error':str(e)}
     return {'message':'Session deleted successfully.'}
 
 
+'''Deletion'''
+
+# Deletions only mark rows so the request returns at once; the rows are purged in batches afterwards
+
+async def forget_sessions(session_ids):
+    for session_id in session_ids:
+        indexes.discard(str(session_id))
+        session_owners.invalidate(str(session_id))
+    await r.delete_sessions(session_ids)
+
+async def purge_user(user_id):
+    try:
+        await db.purge_user(user_id)
+    except Exception:
+        logger.exception("Purging user %s failed; it will be retried on the next startup", user_id)
+
+async def purge_session(session_id):
+    try:
+        await db.purge_session(session_id)
+    except Exception:
+        logger.exception("Purging session %s failed; it will be retried on the next startup", session_id)
+
+async def purge_marked():
+    # Finishes purges that were interrupted by a restart
+    try:
+        for user_id in await db.select_deleted_users():
+            await purge_user(user_id)
+        for session_id in await db.select_deleted_sessions():
+            await purge_session(session_id)
+    except Exception:
+        logger.exception("Sweeping deleted users and sessions failed")
+
+
 '''Chat Routes'''
 
+async def load_history(session_id):
+    if session_id=='new':
+        return base_model.create_chat_history(), ContextWindow(), None
+    records = await r.get_chat_history(session_id, loader=load_records_from_db)
+    # The cached state expires with the history; the rolling summary itself is also stored with the session
+    context = ContextWindow.from_state(await r.get_context(session_id) or await db.get_session_context(session_id))
+    with metrics.span('document_index'):
+        index = await load_document_index(session_id)
+    return base_model.from_records(records), context, index
+
+async def load_records_from_db(session_id):
+    chats = await db.select_chats(session_id)
+    return base_model.load_chat_records(chats, ROLE1, ROLE2)
+
+async def load_document_index(session_id):
+    count = await r.get_document_count(session_id)
+    if count == 0:
+        return None
+    if count is not None:
+        index = indexes.get(session_id, count)
+        if index is not None:
+            return index
+    chunks = await r.get_document_chunks(session_id, loader=db.select_document_chunks)
+    if not chunks:
+        return None
+    index = await asyncio.to_thread(BM25Index, chunks)
+    indexes.put(session_id, index)
+    return index
+
+async def generate_title(session_id, user_id, text, response, committed):
+    # Runs after the response has been sent, using only the first exchange of the session.
+    # The user's cached session list is dropped once the new session is committed and again once it has its title
+    try:
+        if not await committed:
+            return
+        await r.delete_session_list(user_id)
+        title_history = base_model.create_chat_history()
+        base_model.add_user_message(title_history, text)
+        base_model.add_ai_message(title_history, response)
+        async with limiter.slot(user_id):
+            with metrics.span('title'):
+                title = await base_model.achat(title_history, TITLE_QUERY, cache=response_cache.for_route(r, 'title'), route='title')
+        await db.update_session_title(session_id, title.strip().strip('"'))
+        await r.delete_session_list(user_id)
+    except Exception:
+        logger.exception("Title generation failed for session %s", session_id)
+
+async def finish_turn(session_id, chat_history, turn_start, context, text, response, user, background_tasks, document=None):
+    # The session, document and chat rows of a turn are committed together, then the cache is updated in one round trip
+    new_session = session_id == "new"
+    session = document_row = context_row = chunks = None
+    if new_session:
+        session_id = uuid.uuid4()
+        title = PLACEHOLDER_TITLE
+        session = {'id':session_id, 'name':title, 'user_id':user.id, 'summary':context.summary, 'summarized':context.summarized}
+        chunks = []
+    else:
+        title = await db.get_session_title(session_id) or PLACEHOLDER_TITLE   #A write-behind session may not be committed yet
+        if context.summary_changed():
+            context_row = {'session_id':session_id, 'summary':context.summary, 'summarized':context.summarized}
+    if document:
+        filename, new_chunks, index = document
+        document_row = {'id':uuid.uuid4(), 'name':filename, 'chunks':new_chunks, 'session_id':session_id}
+        chunks = index.chunks
+    new_chat = {ROLE1:text, ROLE2:response}
+    with metrics.span('persist'):
+        committed = await writer.write(Turn({'id':uuid.uuid4(), 'conversation':new_chat, 'session_id':session_id}, session, document_row, context_row))
+    with metrics.span('cache_write'):
+        await r.append_chat_history(session_id, base_model.to_records(chat_history[turn_start:]), context.state(), chunks)
+    if document:
+        indexes.put(session_id, index)
+    if new_session:
+        if committed.done():
+            await r.delete_session_list(user.id)
+        session_owners.put(str(session_id), user.id)
+        background_tasks.add_task(generate_title, session_id, user.id, text, response, committed)
+    return session_id, title, new_chat
+
+def sse_event(data, event=None):
+    message = f"data: {json.dumps(data, default=str)}\n\n"
+    if event:
+        message = f"event: {event}\n" + message
+    return message
+
+async def stream_turn(session_id, chat_history, turn_start, context, text, user, background_tasks, reference=None, document=None, cache=None, route=None):
+    # Tokens are forwarded as they arrive; history, cache and database are updated once the stream ends.
+    # The admission slot is taken before the response starts, so a saturated service can still answer 429/503
+    started = await limiter.acquire(user.id)
+    released = False
+    def release():
+        nonlocal released
+        if not released:
+            released = True
+            limiter.release(user.id, started)
+    async def release_after_response():
+        release()
+    async def event_stream():
+        chunks = []
+        try:
+            async for chunk in base_model.astream_chat(chat_history, text, context, reference, cache, route):
+                chunks.append(chunk)
+                yield sse_event({'token':chunk})
+            new_session_id, title, new_chat = await finish_turn(session_id, chat_history, turn_start, context, text, ''.join(chunks), user, background_tasks, document)
+            yield sse_event({'chat':new_chat, 'session_id':new_session_id, 'session_title':title}, event='end')
+        except Exception as e:
+            yield sse_event({'Error':str(e)}, event='error')
+        finally:
+            release()
+    # The body may never be iterated (client gone before the response starts), so the slot is also
+    # released after the response is sent, or when it is dropped without being sent at all
+    background_tasks.add_task(release_after_response)
+    response = StreamingResponse(event_stream(), 
+                                 media_type="text/event-stream", 
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    weakref.finalize(response, release)
+    return response
+
 @app.post('/user/chats/{session_id}/text/')
-async def text_processing(session_id: str, text: str = Form(), current_user: TokenData = Depends(current_user)):
+async def text_processing(session_id: SessionId, 
+                          background_tasks: BackgroundTasks, 
+                          text: str = Form(), 
+                          stream: bool = Form(False), 
+                          current_user: TokenData = Depends(session_owner)):
     try:
-        user = get_user(db, current_user.username)
-        if session_id=='new':
-            chat_history = base_model.create_chat_history()
-        else:
-            # chat_history = current_session_history[user.id]
-            chat_history = await r.get_chat_history(session_id)
+        chat_history, context, index = await load_history(session_id)
+        turn_start = len(chat_history)
+        reference = index.search(text) if index else None
+        cache = response_cache.for_route(r, 'text')
+        if stream:
+            return await stream_turn(session_id, chat_history, turn_start, context, text, current_user, background_tasks, reference, cache=cache, route='text')
         
-        response=base_model.chat(chat_history, text)
-        if session_id == "new":
-            session_id = uuid.uuid4()
-            title = base_model.chat(chat_history, TITLE_QUERY)
-            db.insert_session(session_id, title, user.id)
-        else:
-            session_id = uuid.UUID(session_id)
-            title = db.get_session_title(session_id)
-        # current_session_history[user.id] = chat_history
-        await r.store_chat_history(session_id, chat_history)
-        new_chat = {ROLE1:text, ROLE2:response}
-        db.insert_chat(uuid.uuid4(), new_chat, session_id)
+        async with limiter.slot(current_user.id):
+            response=await base_model.achat(chat_history, text, context, reference, cache, 'text')
+        session_id, title, new_chat = await finish_turn(session_id, chat_history, turn_start, context, text, response, current_user, background_tasks)
+    except HTTPException:
+        raise
     except Exception as e:
         return {'Error':str(e)}
     return {'chat':new_chat, 'session_id':session_id, 'session_title':title}
     
 
 @app.post('/user/chats/{session_id}/document/')
-async def document_processing(session_id: str, 
+async def document_processing(session_id: SessionId, 
+                              background_tasks: BackgroundTasks, 
                               text: Optional[str] = Form(None), 
                               file: UploadFile = File(...), 
-                              current_user: TokenData = Depends(current_user)):
+                              stream: bool = Form(False), 
+                              current_user: TokenData = Depends(session_owner)):
     if not (file.filename.endswith(".pdf") or file.filename.endswith(".docx") or file.filename.endswith(".pptx")):
         raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Invalid File type.")
     
-    contents = await file.read(MAX_FILE_SIZE + 1)
-    if len(contents) > MAX_FILE_SIZE:
-        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="File size exceeds 5MB.")
-    file.file.seek(0)
+    upload = await read_upload(file, MAX_FILE_SIZE)
 
     try:
-        user = get_user(db, current_user.username)
-        if session_id=='new':
-            chat_history = base_model.create_chat_history()
-        else:
-            # chat_history = current_session_history[user.id]
-            chat_history = await r.get_chat_history(session_id)
-        temp_document_path = f"temp_{file.filename}"
-        with open(temp_document_path, "wb") as temp_file:
-            temp_file.write(await file.read())
-        context=dm.load_document(temp_document_path)
-        if text=='':
+        chat_history, context, index = await load_history(session_id)
+        turn_start = len(chat_history)
+        document_text=await dm.load_document(upload)
+        if not text:
             text='What is in this document?'
-        prompt=context+' '+text
+        # Only the excerpts relevant to the question are sent to the model, the document itself stays in the session index
+        with metrics.span('indexing'):
+            new_chunks = await asyncio.to_thread(split_document, document_text)
+            chunks = (index.chunks if index else []) + new_chunks
+            index = await asyncio.to_thread(BM25Index, chunks)
+        reference = index.search(text) or new_chunks[:RETRIEVAL_TOP_K]
+        document = (file.filename, new_chunks, index)
+        cache = response_cache.for_route(r, 'document', upload.digest)
+        if stream:
+            return await stream_turn(session_id, chat_history, turn_start, context, text, current_user, background_tasks, reference, document, cache, 'document')
         
-        response=base_model.chat(chat_history, prompt)
-        if session_id == "new":
-            session_id = uuid.uuid4()
-            title = base_model.chat(chat_history, TITLE_QUERY)
-            title = base_model.chat(chat_history, TITLE_QUERY)
-            db.insert_session(session_id, title, user.id)
-        else:
-            session_id = uuid.UUID(session_id)
-            title = db.get_session_title(session_id)
-        # current_session_history[user.id] = chat_history
-        await r.store_chat_history(session_id, chat_history)
-        new_chat = {ROLE1:text, ROLE2:response}
-        db.insert_chat(uuid.uuid4(), new_chat, session_id)
+        async with limiter.slot(current_user.id):
+            response=await base_model.achat(chat_history, text, context, reference, cache, 'document')
+        session_id, title, new_chat = await finish_turn(session_id, chat_history, turn_start, context, text, response, current_user, background_tasks, document)
+    except HTTPException:
+        raise
     except Exception as e:
         return {'Error':str(e)}
-    finally:
-        if os.path.exists(temp_document_path):
-            os.remove(temp_document_path)
     return {'chat':new_chat, 'session_id':session_id, 'session_title':title}
 
 
 @app.post('/user/chats/{session_id}/image/')
-async def image_processing(session_id: str, 
+async def image_processing(session_id: SessionId, 
+                           background_tasks: BackgroundTasks, 
                            text: Optional[str] = Form(None), 
                            file: UploadFile = File(...), 
-                           current_user: TokenData = Depends(current_user)):
+                           current_user: TokenData = Depends(session_owner)):
     if not (file.content_type.startswith("image/")):
         raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Invalid File type.")
     
-    contents = await file.read(MAX_FILE_SIZE + 1)
-    if len(contents) > MAX_FILE_SIZE:
-        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="File size exceeds 5MB.")
-    file.file.seek(0)
+    upload = await read_upload(file, MAX_FILE_SIZE)
     
     try:
-        user = get_user(db, current_user.username)
-        if session_id=='new':
-            chat_history = base_model.create_chat_history()
-        else:
-            # chat_history = current_session_history[user.id]
-            chat_history = await r.get_chat_history(session_id)
-        temp_image_path = f"temp_{file.filename}"
-        with open(temp_image_path, "wb") as temp_file:
-            temp_file.write(await file.read())
-        if text=='':
+        chat_history, context, _ = await load_history(session_id)
+        turn_start = len(chat_history)
+        if not text:
             text='What is in this image?'
-        prompt = text.replace("{", "{{").replace("}", "}}")
-        prompt=HumanMessagePromptTemplate.from_template(prompt)
-        chat_history.append(prompt)
-        response=image_model.chat(temp_image_path,text)
-        AIresponse = response.replace("{", "{{").replace("}", "}}")
-        AIresponse=AIMessagePromptTemplate.from_template(AIresponse)
-        chat_history.append(AIresponse)
-        if session_id == "new":
-            session_id = uuid.uuid4()
-            title = base_model.chat(chat_history, TITLE_QUERY)
-            db.insert_session(session_id, title, user.id)
-        else:
-            session_id = uuid.UUID(session_id)
-            title = db.get_session_title(session_id)
-        # current_session_history[user.id] = chat_history
-        await r.store_chat_history(session_id, chat_history)
-        new_chat = {ROLE1:text, ROLE2:response}
-        db.insert_chat(uuid.uuid4(), new_chat, session_id)
+        base_model.add_user_message(chat_history, text)
+        async with limiter.slot(current_user.id):
+            response=await image_model.achat(upload.data,text,response_cache.for_route(r, 'image', upload.digest),upload.digest)
+        base_model.add_ai_message(chat_history, response)
+        session_id, title, new_chat = await finish_turn(session_id, chat_history, turn_start, context, text, response, current_user, background_tasks)
+    except HTTPException:
+        raise
     except Exception as e:
         return {'Error':str(e)}
-    finally:
-        if os.path.exists(temp_image_path):
-            os.remove(temp_image_path)
     return {'chat':new_chat, 'session_id':session_id, 'session_title':title}
 
 
+async def init_db():
+    await db.migrate()
+    await db.close()
+
 if __name__=="__main__":
-    db.create_tables()
+    asyncio.run(init_db())
     port = int(os.getenv("PORT", 8000))
     # uvicorn.run("main:app", host="localhost", port=port, reload=True)   #For development
-    uvicorn.run("main:app", host="0.0.0.0", port=port)   #For production
-    db.conn.close()
\ No newline at end of file
+    uvicorn.run("main:app", host="0.0.0.0", port=port)   #For production
\ No newline at end of file
@@ -0,0 +1,181 @@
+import os
+import time
+import bisect
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SLOW_REQUEST_SECONDS = float(os.getenv('SLOW_REQUEST_SECONDS', 0))   #Requests slower than this are logged with their stages, 0 turns it off
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+logger = logging.getLogger(__name__)
+
+# Seconds per stage of the request being handled, None outside of requests
+request_stages = contextvars.ContextVar('request_stages', default=None)
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def label_values(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labelnames)
+
+    def format_labels(self, values, **extra):
+        items = list(zip(self.labelnames, values)) + list(extra.items())
+        if not items:
+            return ''
+        pairs = ','.join(f'{label}="{escape_label(value)}"' for label, value in items)
+        return '{' + pairs + '}'
+
+    def samples(self):
+        with self.lock:
+            return [(self.name + self.format_labels(key), value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for sample, value in self.samples():
+            lines.append(f'{sample} {value}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(self.label_values(labels), 0)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.label_values(labels)] = value
+
+    def value(self, **labels):
+        return self.values.get(self.label_values(labels), 0)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0]*len(self.buckets), 0.0, 0]
+            position = bisect.bisect_left(self.buckets, value)
+            if position < len(self.buckets):
+                entry[0][position] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self.lock:
+            entries = [(key, list(counts), total, count) for key, (counts, total, count) in self.values.items()]
+        samples = []
+        for key, counts, total, count in entries:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append((self.name + '_bucket' + self.format_labels(key, le=f'{bound:g}'), cumulative))
+            samples.append((self.name + '_bucket' + self.format_labels(key, le='+Inf'), count))
+            samples.append((self.name + '_sum' + self.format_labels(key), total))
+            samples.append((self.name + '_count' + self.format_labels(key), count))
+        return samples
+
+
+@contextmanager
+def span(stage):
+    # Times one stage, both in the stage histogram and in the breakdown of the current request
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, stage=stage)
+        stages = request_stages.get()
+        if stages is not None:
+            stages[stage] = stages.get(stage, 0) + elapsed
+
+
+class RequestTiming:
+    '''ASGI middleware recording latency per route, up to the last byte of the response, and logging slow requests.
+
+    Background tasks run after the response and are not counted in the request latency.'''
+
+    def __init__(self, app, slow_seconds=SLOW_REQUEST_SECONDS):
+        self.app = app
+        self.slow_seconds = slow_seconds
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        stages = {}
+        token = request_stages.set(stages)
+        start = time.perf_counter()
+        finished = None
+        status = 500
+
+        async def send_timed(message):
+            nonlocal finished, status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+            if message['type'] == 'http.response.body' and not message.get('more_body', False):
+                finished = (time.perf_counter(), dict(stages))
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            end, breakdown = finished or (time.perf_counter(), dict(stages))
+            elapsed = end - start
+            route = getattr(scope.get('route'), 'path', 'unmatched')
+            request_seconds.observe(elapsed, method=scope['method'], route=route, status=status)
+            if self.slow_seconds and elapsed >= self.slow_seconds:
+                timings = ', '.join(f'{stage}={seconds*1000:.0f}ms' for stage, seconds in sorted(breakdown.items(), key=lambda item: -item[1]))
+                logger.warning("Slow request %s %s %d took %.0fms: %s", scope['method'], route, status, elapsed*1000, timings or 'no stages')
+            request_stages.reset(token)
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render():
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+def count_tokens(model, prompt, completion, source):
+    # source is 'provider' for the usage billed by the model API, 'estimate' when a response carries none
+    prompt_tokens.inc(prompt, model=model, source=source)
+    completion_tokens.inc(completion, model=model, source=source)
+
+
+REGISTRY = []
+
+prompt_tokens = Counter('assistant_prompt_tokens_total', 'Prompt tokens sent to the models, as reported by the provider or estimated where it reports none.', ['model', 'source'])
+prompt_messages_dropped = Counter('assistant_prompt_messages_dropped_total', 'History messages left out of prompts because of the context budget.')
+context_summaries = Counter('assistant_context_summaries_total', 'Rolling summary updates of older chat turns.')
+completion_tokens = Counter('assistant_completion_tokens_total', 'Completion tokens received from the models, as reported by the provider or estimated where it reports none.', ['model', 'source'])
+request_seconds = Histogram('assistant_request_seconds', 'Request latency by route.', ['method', 'route', 'status'])
+stage_seconds = Histogram('assistant_stage_seconds', 'Time spent in each stage of request handling.', ['stage'])
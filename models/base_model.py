@@ -1,51 +1,242 @@
 import os
 from dotenv import load_dotenv
-import os
+from functools import lru_cache
+from typing import NamedTuple
 from langchain_groq import ChatGroq
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import SystemMessagePromptTemplate, HumanMessagePromptTemplate, AIMessagePromptTemplate, ChatPromptTemplate
+from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
+from models.context_manager import estimate_tokens, clip, summary_batches
+import metrics
+from admission import with_retries, stream_with_retries
+
+load_dotenv()
+
+SMALL_MODEL = os.getenv('SMALL_MODEL', 'llama-3.1-8b-instant')
+LARGE_MODEL = os.getenv('LARGE_MODEL', 'llama-3.3-70b-versatile')
+MODEL = LARGE_MODEL
+MODEL_ROUTES = os.getenv('MODEL_ROUTES', 'title:small')   #Tier per route: small, large or auto, e.g. "title:small,document:large"
+SMALL_MESSAGE_TOKENS = int(os.getenv('SMALL_MESSAGE_TOKENS', 60))   #Longest user message the small model answers on auto routes
+SMALL_PROMPT_TOKENS = int(os.getenv('SMALL_PROMPT_TOKENS', 2000))   #Largest whole prompt the small model answers on auto routes
+AI_THEME = "You are a helpful AI assistant."
+SUMMARY_THEME = ("You condense the earlier part of a conversation into a concise summary. "
+                 "Keep the names, facts, decisions and open questions needed to continue it.")
+SUMMARY_PREFIX = 'Summary of the earlier conversation: '
+REFERENCE_PROMPT = 'Use these excerpts from the uploaded documents to answer the question.'
+TIERS = {'small': SMALL_MODEL, 'large': LARGE_MODEL}
+MESSAGE_TYPES = {'system': SystemMessage, 'user': HumanMessage, 'assistant': AIMessage}
+
+model_routes = metrics.Counter('assistant_model_routes_total', 'Model tier chosen for each call, by route and reason.', ['route', 'tier', 'reason'])
 
-def load_model():
+def parse_routes(routes):
+    tiers = {}
+    for item in routes.split(','):
+        if ':' in item:
+            route, tier = item.split(':', 1)
+            if tier.strip().lower() in (*TIERS, 'auto'):
+                tiers[route.strip().lower()] = tier.strip().lower()
+    return tiers
+
+ROUTE_TIERS = parse_routes(MODEL_ROUTES)
+
+@lru_cache(maxsize=None)
+def load_model(model_name=MODEL):
+    # One ChatGroq instance per model is shared so its HTTP connection pools are reused across requests.
+    # Retries are left to admission.with_retries, which backs off with jitter
     load_dotenv()
     api_key=os.getenv('GROQ_API_KEY')
     # os.environ["GROQ_API_KEY"]=api_key
-    model = ChatGroq(api_key=api_key, model="llama-3.3-70b-versatile")
+    model = ChatGroq(api_key=api_key, model=model_name, max_retries=0)
     return model
 
+def choose_model(route, message_tokens, prompt_tokens, grounded=False):
+    # Routes pinned to a tier always use it; auto routes send short, ungrounded prompts to the small model
+    tier=ROUTE_TIERS.get(route, 'auto')
+    reason='route'
+    if tier == 'auto':
+        if grounded:
+            tier, reason = 'large', 'reference'
+        elif message_tokens > SMALL_MESSAGE_TOKENS:
+            tier, reason = 'large', 'long_message'
+        elif prompt_tokens > SMALL_PROMPT_TOKENS:
+            tier, reason = 'large', 'long_prompt'
+        else:
+            tier, reason = 'small', 'short_prompt'
+    model_routes.inc(route=route or 'default', tier=tier, reason=reason)
+    return TIERS[tier]
+
+def usage_tokens(message):
+    # Prompt and completion tokens reported by the provider, None if the message carries no usage
+    usage=getattr(message, 'usage_metadata', None)
+    if usage:
+        return usage['input_tokens'], usage['output_tokens']
+    usage=(getattr(message, 'response_metadata', None) or {}).get('token_usage')
+    if usage:
+        return usage['prompt_tokens'], usage['completion_tokens']
+    return None
+
+def count_tokens(model_name, messages, response, usage=None):
+    if usage:
+        metrics.count_tokens(model_name, *usage, 'provider')
+    else:
+        metrics.count_tokens(model_name, sum(estimate_tokens(message.content) for message in messages), estimate_tokens(response), 'estimate')
+
+def route_prompt(prompt, route, reference=None):
+    sizes=[estimate_tokens(message.content) for message in prompt]
+    return choose_model(route, sizes[-1], sum(sizes), bool(reference))
+
+class Message(NamedTuple):
+    '''One chat message. Content is sent to the model as is, it is never parsed as a template.'''
+    role: str   #system, user or assistant
+    content: str
+
 def create_chat_history():
-    ai_theme="You are a helpful AI assistant."
-    system_message=SystemMessagePromptTemplate.from_template(ai_theme)
-    chat_history=[system_message]
+    chat_history=[Message('system', AI_THEME)]
     return chat_history
 
-def load_chat_history(chats, role1, role2):
-    chat_history=create_chat_history()
+def to_model_messages(prompt):
+    return [MESSAGE_TYPES[message.role](content=message.content) for message in prompt]
+
+def build_chain(model_name=MODEL):
+    model=load_model(model_name)
+    chain=model|StrOutputParser()
+    return chain
+
+def add_user_message(chat_history, text):
+    chat_history.append(Message('user', text))
+
+def add_ai_message(chat_history, response):
+    chat_history.append(Message('assistant', response))
+
+def load_chat_records(chats, role1, role2):
+    records=[]
     if chats:
         for chat in chats:
-            user_msg=chat[role1]
-            ai_msg=chat[role2]
-            user_msg, ai_msg = user_msg.replace("{", "{{").replace("}", "}}"), ai_msg.replace("{", "{{").replace("}", "}}")
-            chat_history.append(HumanMessagePromptTemplate.from_template(user_msg))
-            chat_history.append(AIMessagePromptTemplate.from_template(ai_msg))
+            records.append({'role':'user', 'content':chat[role1]})
+            records.append({'role':'assistant', 'content':chat[role2]})
+    return records
+
+def to_records(chat_history):
+    return [message._asdict() for message in chat_history if message.role!='system']
+
+def from_records(records):
+    chat_history=create_chat_history()
+    chat_history.extend(Message(record['role'], record['content']) for record in records)
     return chat_history
 
+async def asummarize(summary, messages):
+    lines=[]
+    if summary:
+        lines.append(f'Current summary:\n{summary}\n')
+    lines.append('New messages:')
+    for message in messages:
+        role='User' if message.role=='user' else 'Assistant'
+        lines.append(f'{role}: {clip(message.content)}')
+    with metrics.span('summary'):
+        messages=[SystemMessage(content=SUMMARY_THEME), HumanMessage(content='\n'.join(lines))]
+        tokens=estimate_tokens(messages[-1].content)
+        model_name=choose_model('summary', tokens, tokens)
+        response=await with_retries(lambda: load_model(model_name).ainvoke(messages))
+    count_tokens(model_name, messages, response.content, usage_tokens(response))
+    return response.content
+
+def with_reference(text, reference):
+    excerpts='\n\n'.join(f'Excerpt {number}:\n{chunk}' for number, chunk in enumerate(reference, 1))
+    return f'{REFERENCE_PROMPT}\n\n{excerpts}\n\nQuestion: {text}'
+
+async def abuild_prompt(chat_history, context=None, reference=None):
+    # Keeps the system message, a rolling summary of older turns and the most recent turns within the token budget.
+    # Retrieved document excerpts are attached to the latest user message for this call only.
+    reference_text=with_reference(chat_history[-1].content, reference) if reference else None
+    if context is None:
+        prompt=list(chat_history)
+    else:
+        system_message, messages = chat_history[0], chat_history[1:]
+        sizes=[estimate_tokens(message.content) for message in messages]
+        system_tokens=estimate_tokens(system_message.content)
+        if reference_text:
+            system_tokens+=estimate_tokens(reference_text)-sizes[-1]
+        start=context.window_start(sizes, system_tokens)
+        # A long history (e.g. reloaded without its stored summary) is folded in over several bounded calls
+        for end in summary_batches(sizes, context.summarized, start):
+            context.summary=await asummarize(context.summary, messages[context.summarized:end])
+            context.summarized=end
+            metrics.context_summaries.inc()
+        prompt=[system_message]
+        prompt_tokens=system_tokens+sum(sizes[start:])
+        if context.summary:
+            prompt.append(Message('system', SUMMARY_PREFIX+context.summary))
+            prompt_tokens+=estimate_tokens(context.summary)
+        prompt.extend(messages[start:])
+        context.record(prompt_tokens, len(messages)-start, len(messages))
+        metrics.prompt_messages_dropped.inc(start)
+    if reference_text:
+        prompt[-1]=Message('user', reference_text)
+    return prompt
+
 def generate_response(chat_history):
-    model=load_model()
-    chat_template=ChatPromptTemplate.from_messages(chat_history)
-    chain=chat_template|model|StrOutputParser()
-    response=chain.invoke({})
+    chain=build_chain()
+    response=chain.invoke(to_model_messages(chat_history))
+    return response
+
+async def agenerate_response(chat_history, context=None, reference=None, cache=None, route=None):
+    prompt=await abuild_prompt(chat_history, context, reference)
+    model_name=route_prompt(prompt, route, reference)
+    if cache is not None:
+        key=cache.key(model_name, [(message.role, message.content) for message in prompt])
+        response=await cache.get(key)
+        if response is not None:
+            return response
+    # The model is called without the output parser so the provider's token usage stays available
+    model=load_model(model_name)
+    messages=to_model_messages(prompt)
+    with metrics.span('llm'):
+        message=await with_retries(lambda: model.ainvoke(messages))
+    response=message.content
+    count_tokens(model_name, messages, response, usage_tokens(message))
+    if cache is not None:
+        await cache.set(key, response)
     return response
 
 def chat(chat_history, text):
-    text = text.replace("{", "{{").replace("}", "}}")
-    prompt=HumanMessagePromptTemplate.from_template(text)
-    chat_history.append(prompt)
+    add_user_message(chat_history, text)
     response=generate_response(chat_history)
-    AIresponse = response.replace("{", "{{").replace("}", "}}")
-    AIresponse=AIMessagePromptTemplate.from_template(AIresponse)
-    chat_history.append(AIresponse)
+    add_ai_message(chat_history, response)
     return response
 
+async def achat(chat_history, text, context=None, reference=None, cache=None, route=None):
+    add_user_message(chat_history, text)
+    response=await agenerate_response(chat_history, context, reference, cache, route)
+    add_ai_message(chat_history, response)
+    return response
+
+async def astream_chat(chat_history, text, context=None, reference=None, cache=None, route=None):
+    add_user_message(chat_history, text)
+    prompt=await abuild_prompt(chat_history, context, reference)
+    model_name=route_prompt(prompt, route, reference)
+    response=None
+    if cache is not None:
+        key=cache.key(model_name, [(message.role, message.content) for message in prompt])
+        response=await cache.get(key)
+    if response is not None:
+        yield response
+    else:
+        model=load_model(model_name)
+        messages=to_model_messages(prompt)
+        chunks=[]
+        usage=None
+        # Includes the time the client takes to receive each chunk
+        with metrics.span('llm'):
+            async for chunk in stream_with_retries(lambda: model.astream(messages)):
+                usage=usage_tokens(chunk) or usage   #Carried by the last chunk when the provider reports it
+                if chunk.content:
+                    chunks.append(chunk.content)
+                    yield chunk.content
+        response=''.join(chunks)
+        count_tokens(model_name, messages, response, usage)
+        if cache is not None:
+            await cache.set(key, response)
+    add_ai_message(chat_history, response)
+
 if __name__=='__main__':
     chat_history = create_chat_history()
     while True:
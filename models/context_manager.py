@@ -0,0 +1,99 @@
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', 6000))
+CONTEXT_RETAIN_RATIO = float(os.getenv('CONTEXT_RETAIN_RATIO', 0.6))   #Share of the budget kept for recent turns after the window moves
+SUMMARY_MESSAGE_TOKENS = int(os.getenv('SUMMARY_MESSAGE_TOKENS', 1000))
+SUMMARY_BATCH_TOKENS = int(os.getenv('SUMMARY_BATCH_TOKENS', 8000))   #Most message tokens folded into the summary per model call
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4
+
+def estimate_tokens(text):
+    return len(text)//CHARS_PER_TOKEN + MESSAGE_OVERHEAD_TOKENS
+
+def clip(text, max_tokens=SUMMARY_MESSAGE_TOKENS):
+    max_chars = max_tokens*CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars] + ' ...'
+
+def summary_batches(sizes, start, end, max_tokens=SUMMARY_BATCH_TOKENS):
+    # Splits sizes[start:end] into runs small enough for one summary call, each holding at least one message
+    batch_tokens = 0
+    for position in range(start, end):
+        size = min(sizes[position], SUMMARY_MESSAGE_TOKENS + MESSAGE_OVERHEAD_TOKENS)
+        if batch_tokens and batch_tokens + size > max_tokens:
+            yield position
+            batch_tokens = 0
+        batch_tokens += size
+    if batch_tokens:
+        yield end
+
+
+class ContextWindow:
+    def __init__(self, summary='', summarized=0, token_budget=CONTEXT_TOKEN_BUDGET):
+        self.summary = summary
+        self.summarized = summarized    #Number of history messages already folded into the summary
+        self.stored_summarized = summarized    #summarized as last saved with the session, to tell when to save it again
+        self.token_budget = token_budget
+        self.prompt_tokens = 0
+        self.max_prompt_tokens = 0
+        self.messages_sent = 0
+        self.messages_total = 0
+
+    @classmethod
+    def from_state(cls, state):
+        context = cls(summary=state.get('summary', ''), summarized=int(state.get('summarized', 0)))
+        context.prompt_tokens = int(state.get('prompt_tokens', 0))
+        context.max_prompt_tokens = int(state.get('max_prompt_tokens', 0))
+        context.messages_sent = int(state.get('messages_sent', 0))
+        context.messages_total = int(state.get('messages_total', 0))
+        return context
+
+    def state(self):
+        return {
+            'summary': self.summary,
+            'summarized': self.summarized,
+            'prompt_tokens': self.prompt_tokens,
+            'max_prompt_tokens': self.max_prompt_tokens,
+            'messages_sent': self.messages_sent,
+            'messages_total': self.messages_total
+        }
+
+    def summary_changed(self):
+        return self.summarized != self.stored_summarized
+
+    def stats(self):
+        return {
+            'token_budget': self.token_budget,
+            'summarized_messages': self.summarized,
+            'summary_tokens': estimate_tokens(self.summary) if self.summary else 0,
+            'prompt_tokens': self.prompt_tokens,
+            'max_prompt_tokens': self.max_prompt_tokens,
+            'messages_sent': self.messages_sent,
+            'messages_total': self.messages_total
+        }
+
+    def window_start(self, sizes, fixed_tokens):
+        # The window only moves forward, and when it does it leaves headroom so the summary is not rebuilt every turn
+        if self.summarized > len(sizes):
+            self.summary, self.summarized = '', 0
+        start = self.summarized
+        if self.summary:
+            fixed_tokens += estimate_tokens(self.summary)
+        total = fixed_tokens + sum(sizes[start:])
+        if total <= self.token_budget:
+            return start
+        target = self.token_budget*CONTEXT_RETAIN_RATIO
+        while start < len(sizes)-1 and total > target:
+            total -= sizes[start]
+            start += 1
+        return start
+
+    def record(self, prompt_tokens, messages_sent, messages_total):
+        self.prompt_tokens = prompt_tokens
+        self.max_prompt_tokens = max(self.max_prompt_tokens, prompt_tokens)
+        self.messages_sent = messages_sent
+        self.messages_total = messages_total
@@ -1,41 +1,223 @@
-'''Extraction through API (Online)'''
-
 import os
 from dotenv import load_dotenv
 import time
-from unstract.llmwhisperer import LLMWhispererClientV2
+import asyncio
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from models.extraction_cache import ExtractionCache
+import metrics
+
+load_dotenv()
+
+DOCUMENT_EXTRACTOR = os.getenv('DOCUMENT_EXTRACTOR', 'local')   #local or remote
+DOCUMENT_EXTRACTOR_OVERRIDES = os.getenv('DOCUMENT_EXTRACTOR_OVERRIDES', '')   #Per file type, e.g. "pdf:remote,pptx:local"
+EXTRACTION_FALLBACK = os.getenv('EXTRACTION_FALLBACK', 'true').lower() == 'true'   #Retry failed local extractions remotely
+EXTRACTION_WORKERS = int(os.getenv('EXTRACTION_WORKERS', os.cpu_count() or 1))
+EXTRACTION_TIMEOUT = float(os.getenv('EXTRACTION_TIMEOUT', 120))
+EXTRACTION_MAX_CONCURRENCY = int(os.getenv('EXTRACTION_MAX_CONCURRENCY', 4))
+EXTRACTION_POLL_INITIAL = float(os.getenv('EXTRACTION_POLL_INITIAL', 0.5))
+EXTRACTION_POLL_MAX = float(os.getenv('EXTRACTION_POLL_MAX', 8))
+EXTRACTION_POLL_FACTOR = 2
+
+extraction_polls = metrics.Counter('assistant_extraction_polls_total', 'Status polls sent for remote extraction jobs.')
+extractions = metrics.Counter('assistant_extractions_total', 'Document extractions by backend and outcome.', ['backend', 'result'])
+
+
+class ExtractionTimeout(Exception):
+    pass
+
+
+def file_type(filename):
+    return os.path.splitext(filename)[1].lower().lstrip('.')
+
+def parse_overrides(overrides):
+    backends = {}
+    for item in overrides.split(','):
+        if ':' in item:
+            extension, backend = item.split(':', 1)
+            backends[extension.strip().lower().lstrip('.')] = backend.strip().lower()
+    return backends
+
+
+
+'''Extraction through API (Online)'''
+
+class RemoteExtractor:
+    def __init__(self, api_key):
+        from unstract.llmwhisperer import LLMWhispererClientV2
+        self.client = LLMWhispererClientV2(api_key=api_key)
+        self.slots = asyncio.Semaphore(EXTRACTION_MAX_CONCURRENCY)
+
+    async def extract(self, documents, timeout=EXTRACTION_TIMEOUT):
+        # Jobs are submitted while extraction slots are free and all pending jobs are polled together,
+        # starting with a short interval and backing off exponentially until the deadline
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        texts = [None]*len(documents)
+        waiting = list(enumerate(documents))
+        pending = {}
+        interval = EXTRACTION_POLL_INITIAL
+        try:
+            while waiting or pending:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise ExtractionTimeout(f"Document extraction did not finish within {timeout:g} seconds.")
+                if waiting and not pending:
+                    try:
+                        await asyncio.wait_for(self.slots.acquire(), remaining)
+                    except asyncio.TimeoutError:
+                        continue
+                    await self.submit(*waiting.pop(0), pending)
+                    interval = EXTRACTION_POLL_INITIAL
+                while waiting and not self.slots.locked():
+                    await self.slots.acquire()
+                    await self.submit(*waiting.pop(0), pending)
+                    interval = EXTRACTION_POLL_INITIAL
+                if not pending:
+                    continue
+                await asyncio.sleep(min(interval, max(deadline - loop.time(), 0)))
+                interval = min(interval*EXTRACTION_POLL_FACTOR, EXTRACTION_POLL_MAX)
+                whisper_hashes = list(pending)
+                statuses = await asyncio.gather(*(asyncio.to_thread(self.client.whisper_status, whisper_hash=whisper_hash) 
+                                                  for whisper_hash in whisper_hashes))
+                extraction_polls.inc(len(whisper_hashes))
+                for whisper_hash, status in zip(whisper_hashes, statuses):
+                    if status["status"] == "processed":
+                        result = await asyncio.to_thread(self.client.whisper_retrieve, whisper_hash=whisper_hash)
+                        texts[pending.pop(whisper_hash)] = result['extraction']['result_text']
+                        self.slots.release()
+                    elif status["status"] == "error":
+                        raise Exception(f"Document extraction failed: {status.get('message', 'unknown error')}")
+        finally:
+            for _ in pending:
+                self.slots.release()
+        return texts
+
+    async def submit(self, index, document, pending):
+        try:
+            result = await asyncio.to_thread(self.client.whisper, stream=io.BytesIO(document.data))
+        except Exception:
+            self.slots.release()
+            raise
+        if result["status_code"] == 202:
+            pending[result["whisper_hash"]] = index
+        else:
+            self.slots.release()
+
+    def close(self):
+        pass
+
+
+
+'''Extraction through Computation'''
+
+def load_document(data, filename):
+    # Runs inside a worker process, so the parsing libraries are only imported where they are used
+    from langchain_unstructured import UnstructuredLoader
+    from unstructured.cleaners.core import clean_extra_whitespace, remove_punctuation
+    text=""
+    loader = UnstructuredLoader(file=io.BytesIO(data),
+                                metadata_filename=filename,
+                                post_processors=[clean_extra_whitespace, remove_punctuation],
+                                chunking_strategy="basic",
+                                max_characters=1000000,
+                                include_orig_elements=False,)
+    docs = loader.load()
+    for doc in docs:
+        text=text+doc.page_content
+    return text
+
+class LocalExtractor:
+    def __init__(self, max_workers=EXTRACTION_WORKERS):
+        self.max_workers = max_workers
+        self.pool = None
+
+    def submit(self, documents):
+        if self.pool is None:
+            # Spawned rather than forked, so workers do not inherit the running event loop and thread pools
+            self.pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+        loop = asyncio.get_running_loop()
+        return [loop.run_in_executor(self.pool, load_document, document.data, document.filename) for document in documents]
+
+    async def extract(self, documents, timeout=EXTRACTION_TIMEOUT):
+        # Failures are returned per document, timeouts included, so the caller can fall back for those documents
+        try:
+            jobs = self.submit(documents)
+        except BrokenProcessPool:
+            # A worker died (out of memory, a crash in a parser) during an earlier extraction and broke the pool
+            self.close()
+            jobs = self.submit(documents)
+        done, pending = await asyncio.wait(jobs, timeout=timeout)
+        for job in pending:
+            job.cancel()
+        timeout_error = ExtractionTimeout(f"Document extraction did not finish within {timeout:g} seconds.")
+        results = [timeout_error if job in pending else job.exception() or job.result() for job in jobs]
+        if any(isinstance(result, BrokenProcessPool) for result in results):
+            self.close()
+        return results
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+
 
 class DocumentLoader:
     def __init__(self):
         load_dotenv()
         api_key = os.getenv('LLMWHISPERER_API_KEY')
-        self.client = LLMWhispererClientV2(api_key=api_key)
+        self.extractors = {'local': LocalExtractor()}
+        if api_key:
+            self.extractors['remote'] = RemoteExtractor(api_key)
+        self.overrides = parse_overrides(DOCUMENT_EXTRACTOR_OVERRIDES)
+        self.cache = ExtractionCache()
 
-    def load_document(self, document):
-        result = self.client.whisper(file_path=document)
-        if result["status_code"] == 202:
-            while True:
-                status = self.client.whisper_status(whisper_hash=result["whisper_hash"])
-                if status["status"] == "processed":
-                    resultx = self.client.whisper_retrieve(whisper_hash=result["whisper_hash"])
-                    return resultx['extraction']['result_text']
-                time.sleep(5)
+    def backend(self, document):
+        backend = self.overrides.get(file_type(document.filename), DOCUMENT_EXTRACTOR)
+        if backend not in self.extractors:
+            backend = 'local'
+        return backend
 
+    async def load_document(self, document):
+        with metrics.span('document_load'):
+            texts = await self.load_documents([document])
+        return texts[0]
 
+    async def load_documents(self, documents):
+        # Documents are uploads carrying filename, data and the SHA-256 digest of the data
+        digests = [document.digest for document in documents]
+        texts = await asyncio.gather(*(asyncio.to_thread(self.cache.get, digest) for digest in digests))
+        groups = {}
+        for index, text in enumerate(texts):
+            if text is None:
+                groups.setdefault(self.backend(documents[index]), []).append(index)
+        for backend, indexes in groups.items():
+            start = time.perf_counter()
+            results = await self.extract(backend, [documents[index] for index in indexes])
+            seconds = time.perf_counter() - start
+            for index, text in zip(indexes, results):
+                texts[index] = text
+                if text is not None:
+                    await asyncio.to_thread(self.cache.put, digests[index], text, seconds)
+        return texts
 
-'''Extraction through Computation'''
+    async def extract(self, backend, documents):
+        results = await self.extractors[backend].extract(documents)
+        failed = [index for index, result in enumerate(results) if isinstance(result, BaseException)]
+        extractions.inc(len(documents) - len(failed), backend=backend, result='ok')
+        extractions.inc(len(failed), backend=backend, result='error')
+        if failed and backend == 'local' and EXTRACTION_FALLBACK and 'remote' in self.extractors:
+            fallback = await self.extract('remote', [documents[index] for index in failed])
+            for index, result in zip(failed, fallback):
+                results[index] = result
+            failed = [index for index, result in enumerate(results) if isinstance(result, BaseException)]
+        if failed:
+            raise results[failed[0]]
+        return results
 
-# from langchain_unstructured import UnstructuredLoader
-# from unstructured.cleaners.core import clean_extra_whitespace, remove_punctuation
-
-# def load_document(document):
-#     text=""
-#     loader = UnstructuredLoader([document],
-#                                 post_processors=[clean_extra_whitespace, remove_punctuation],
-#                                 chunking_strategy="basic",
-#                                 max_characters=1000000,
-#                                 include_orig_elements=False,)
-#     docs = loader.load()
-#     for doc in docs:
-#         text=text+doc.page_content
-#     return text
\ No newline at end of file
+    def close(self):
+        for extractor in self.extractors.values():
+            extractor.close()
@@ -0,0 +1,64 @@
+import os
+import json
+import threading
+from dotenv import load_dotenv
+import metrics
+
+load_dotenv()
+
+EXTRACTION_CACHE_DIR = os.getenv('EXTRACTION_CACHE_DIR', '.extraction_cache')
+EXTRACTION_CACHE_MAX_BYTES = int(os.getenv('EXTRACTION_CACHE_MAX_BYTES', 268435456))   #256MB
+
+extraction_cache_requests = metrics.Counter('assistant_extraction_cache_requests_total', 'Document extraction cache lookups.', ['result'])
+extraction_seconds_saved = metrics.Counter('assistant_extraction_seconds_saved_total', 'Extraction time avoided by extraction cache hits.')
+
+
+class ExtractionCache:
+    '''Extracted document text keyed by the SHA-256 of the file bytes, evicted least recently used first.'''
+
+    def __init__(self, directory=EXTRACTION_CACHE_DIR, max_bytes=EXTRACTION_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.directory, f'{digest}.json')
+
+    def get(self, digest):
+        path = self.path(digest)
+        try:
+            with open(path, 'r', encoding='utf-8') as entry_file:
+                entry = json.load(entry_file)
+            os.utime(path)
+        except (OSError, ValueError):
+            extraction_cache_requests.inc(result='miss')
+            return None
+        extraction_cache_requests.inc(result='hit')
+        extraction_seconds_saved.inc(entry.get('seconds', 0))
+        return entry['text']
+
+    def put(self, digest, text, seconds=0):
+        path = self.path(digest)
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as entry_file:
+            json.dump({'text': text, 'seconds': seconds}, entry_file)
+        os.replace(temp_path, path)
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.json'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
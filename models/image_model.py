@@ -1,39 +1,88 @@
-from groq import Groq
+from groq import Groq, AsyncGroq
 import os
 import base64
 from dotenv import load_dotenv
+from functools import lru_cache
+from models.image_preprocessing import ImagePreprocessor
+from models.context_manager import estimate_tokens
+import metrics
+from admission import with_retries
 
+MODEL = "llama-3.2-11b-vision-preview"
+
+preprocessor = ImagePreprocessor()
+
+@lru_cache(maxsize=None)
 def load_client():
     load_dotenv()
     api_key=os.getenv('GROQ_API_KEY')
     client = Groq(api_key=api_key)
     return client
 
+@lru_cache(maxsize=None)
+def load_async_client():
+    load_dotenv()
+    api_key=os.getenv('GROQ_API_KEY')
+    client = AsyncGroq(api_key=api_key, max_retries=0)   #Retried by admission.with_retries
+    return client
+
 # Function to encode the image
 def encode_image(image_path):
   with open(image_path, "rb") as image_file:
-    return base64.b64encode(image_file.read()).decode('utf-8')
+    return encode_image_bytes(image_file.read())
+
+def encode_image_bytes(image_data):
+  return base64.b64encode(image_data).decode('utf-8')
+
+def build_messages(base64_image, text, mime_type="image/jpeg"):
+    return [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": text},
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:{mime_type};base64,{base64_image}",
+                    },
+                },
+            ],
+        }
+    ]
 
 # Getting the base64 string
 def chat(image_path,text):
     client=load_client()
     base64_image = encode_image(image_path)
     chat_completion = client.chat.completions.create(
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": text},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}",
-                        },
-                    },
-                ],
-            }
-        ],
-        model="llama-3.2-11b-vision-preview",
+        messages=build_messages(base64_image, text),
+        model=MODEL,
     )
     response = (chat_completion.choices[0].message.content)
-    return response
\ No newline at end of file
+    return response
+
+async def achat(image_data,text,cache=None,digest=None):
+    if cache is not None:
+        key = cache.key(MODEL, [("user", text)])
+        response = await cache.get(key)
+        if response is not None:
+            return response
+    client=load_async_client()
+    with metrics.span('image_preprocess'):
+        image_data, mime_type = await preprocessor.prepare(image_data, digest)
+    base64_image = encode_image_bytes(image_data)
+    with metrics.span('vision'):
+        messages = build_messages(base64_image, text, mime_type)
+        chat_completion = await with_retries(lambda: client.chat.completions.create(
+            messages=messages,
+            model=MODEL,
+        ))
+    response = (chat_completion.choices[0].message.content)
+    usage = getattr(chat_completion, "usage", None)
+    if usage:
+        metrics.count_tokens(MODEL, usage.prompt_tokens, usage.completion_tokens, 'provider')
+    else:
+        metrics.count_tokens(MODEL, estimate_tokens(text), estimate_tokens(response), 'estimate')
+    if cache is not None:
+        await cache.set(key, response)
+    return response
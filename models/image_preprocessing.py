@@ -0,0 +1,81 @@
+import io
+import os
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from PIL import Image, ImageOps
+import metrics
+
+load_dotenv()
+
+IMAGE_MAX_DIMENSION = int(os.getenv('IMAGE_MAX_DIMENSION', 1120))   #Longest side sent to the vision model
+IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', 85))
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', 4))
+IMAGE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_CACHE_MAX_BYTES', 67108864))   #64MB
+PASSTHROUGH_FORMATS = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'WEBP': 'image/webp', 'GIF': 'image/gif'}
+
+image_bytes = metrics.Counter('assistant_image_bytes_total', 'Image bytes before and after preprocessing.', ['stage'])
+image_cache_requests = metrics.Counter('assistant_image_cache_requests_total', 'Preprocessed image cache lookups.', ['result'])
+
+
+def preprocess_image(data):
+    # Applies the EXIF orientation, caps the longest side and re-encodes as JPEG;
+    # the original is kept when it is already small enough and re-encoding would not shrink it
+    with Image.open(io.BytesIO(data)) as image:
+        original_format = image.format
+        image = ImageOps.exif_transpose(image)
+        resized = max(image.size) > IMAGE_MAX_DIMENSION
+        if resized:
+            image.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.LANCZOS)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=IMAGE_QUALITY, optimize=True)
+    encoded = output.getvalue()
+    if not resized and original_format in PASSTHROUGH_FORMATS and len(data) <= len(encoded):
+        return data, PASSTHROUGH_FORMATS[original_format]
+    return encoded, 'image/jpeg'
+
+
+class ImagePreprocessor:
+    '''Runs preprocess_image in a thread pool and keeps results by content hash, evicting least recently used first.'''
+
+    def __init__(self, max_workers=IMAGE_WORKERS, max_bytes=IMAGE_CACHE_MAX_BYTES):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='image')
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    async def prepare(self, data, digest=None):
+        digest = digest or hashlib.sha256(data).hexdigest()
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is not None:
+                self.entries.move_to_end(digest)
+        image_cache_requests.inc(result='miss' if entry is None else 'hit')
+        if entry is not None:
+            return entry
+        loop = asyncio.get_running_loop()
+        entry = await loop.run_in_executor(self.pool, preprocess_image, data)
+        image_bytes.inc(len(data), stage='original')
+        image_bytes.inc(len(entry[0]), stage='processed')
+        with self.lock:
+            if digest not in self.entries:
+                self.entries[digest] = entry
+                self.size += len(entry[0])
+            while self.size > self.max_bytes and self.entries:
+                _, (evicted, _) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+        return entry
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,82 @@
+import os
+import re
+import math
+import heapq
+from collections import Counter, OrderedDict
+from dotenv import load_dotenv
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+load_dotenv()
+
+CHUNK_SIZE = int(os.getenv('CHUNK_SIZE', 1500))   #Characters
+CHUNK_OVERLAP = int(os.getenv('CHUNK_OVERLAP', 150))
+RETRIEVAL_TOP_K = int(os.getenv('RETRIEVAL_TOP_K', 4))
+INDEX_CACHE_SIZE = int(os.getenv('INDEX_CACHE_SIZE', 256))   #Sessions whose index is kept in memory
+
+TOKEN_PATTERN = re.compile(r'\w+')
+STOPWORDS = frozenset('a an and are as at be by do does for from how i in is it me of on or tell that the this to was what when where which who why with you'.split())
+
+splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+
+def split_document(text):
+    return splitter.split_text(text)
+
+def tokenize(text):
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+class BM25Index:
+    def __init__(self, chunks, k1=1.5, b=0.75):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        self.lengths = []
+        self.postings = {}
+        for position, chunk in enumerate(chunks):
+            frequencies = Counter(tokenize(chunk))
+            self.lengths.append(sum(frequencies.values()))
+            for term, frequency in frequencies.items():
+                self.postings.setdefault(term, []).append((position, frequency))
+        count = len(chunks)
+        self.average_length = sum(self.lengths)/count if count else 0
+        self.idf = {term: math.log(1 + (count - len(postings) + 0.5)/(len(postings) + 0.5)) 
+                    for term, postings in self.postings.items()}
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def search(self, query, k=RETRIEVAL_TOP_K):
+        scores = {}
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for position, frequency in self.postings[term]:
+                norm = self.k1*(1 - self.b + self.b*self.lengths[position]/self.average_length)
+                scores[position] = scores.get(position, 0) + idf*frequency*(self.k1 + 1)/(frequency + norm)
+        top = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [self.chunks[position] for position in sorted(position for position, _ in top)]
+
+
+class IndexCache:
+    '''Built BM25 indexes per session, reused while the session's chunk count is unchanged.'''
+
+    def __init__(self, max_size=INDEX_CACHE_SIZE):
+        self.max_size = max_size
+        self.indexes = OrderedDict()
+
+    def get(self, session_id, count):
+        entry = self.indexes.get(str(session_id))
+        if entry is None or len(entry) != count:
+            return None
+        self.indexes.move_to_end(str(session_id))
+        return entry
+
+    def put(self, session_id, index):
+        self.indexes[str(session_id)] = index
+        self.indexes.move_to_end(str(session_id))
+        while len(self.indexes) > self.max_size:
+            self.indexes.popitem(last=False)
+
+    def discard(self, session_id):
+        self.indexes.pop(str(session_id), None)
@@ -0,0 +1,50 @@
+import os
+import json
+import hashlib
+from dotenv import load_dotenv
+import metrics
+
+load_dotenv()
+
+RESPONSE_CACHE_ROUTES = frozenset(route.strip() for route in os.getenv('RESPONSE_CACHE_ROUTES', '').split(',') if route.strip())   #e.g. "document,image,title"
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 86400))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 65536))   #Larger responses are not cached
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 10000))
+
+response_cache_requests = metrics.Counter('assistant_response_cache_requests_total', 'Model response cache lookups.', ['route', 'result'])
+
+
+def normalize(text):
+    return ' '.join(text.split())
+
+def request_key(model, messages, content_hash=''):
+    payload = json.dumps([model, content_hash, [[role, normalize(content)] for role, content in messages]], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    '''Model responses keyed by model name, the normalized message list and the hash of any attached content.'''
+
+    def __init__(self, cache, route, content_hash=''):
+        self.cache = cache
+        self.route = route
+        self.content_hash = content_hash
+
+    def key(self, model, messages):
+        return request_key(model, messages, self.content_hash)
+
+    async def get(self, key):
+        response = await self.cache.get_response(key)
+        response_cache_requests.inc(route=self.route, result='miss' if response is None else 'hit')
+        return response
+
+    async def set(self, key, response):
+        if len(response.encode('utf-8')) > RESPONSE_CACHE_MAX_BYTES:
+            return
+        await self.cache.store_response(key, response, RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES)
+
+
+def for_route(cache, route, content_hash=''):
+    if route not in RESPONSE_CACHE_ROUTES:
+        return None
+    return ResponseCache(cache, route, content_hash)
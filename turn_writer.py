@@ -0,0 +1,102 @@
+import os
+import asyncio
+import logging
+from typing import NamedTuple, Optional
+from dotenv import load_dotenv
+import metrics
+
+load_dotenv()
+
+WRITE_BEHIND = os.getenv('WRITE_BEHIND', 'false').lower() == 'true'   #Queue turns and commit them in batches
+WRITE_BEHIND_QUEUE_SIZE = int(os.getenv('WRITE_BEHIND_QUEUE_SIZE', 1000))   #Turns wait for room once the queue is full
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv('WRITE_BEHIND_BATCH_SIZE', 100))
+WRITE_BEHIND_MAX_DELAY = float(os.getenv('WRITE_BEHIND_MAX_DELAY', 0.05))   #Seconds a turn may wait for others to join its batch
+
+logger = logging.getLogger(__name__)
+
+turn_commits = metrics.Counter('assistant_turn_commits_total', 'Database transactions used to persist chat turns.')
+turns_written = metrics.Counter('assistant_turns_written_total', 'Chat turns persisted to the database.', ['result'])
+
+
+class Turn(NamedTuple):
+    chat: dict
+    session: Optional[dict] = None
+    document: Optional[dict] = None
+    context: Optional[dict] = None
+
+
+class TurnWriter:
+    '''Persists chat turns, either one transaction per turn or, in write-behind mode, batched from a bounded queue.
+
+    write() returns a future that resolves to True once the turn is committed, or False if it could not be.'''
+
+    def __init__(self, db, write_behind=WRITE_BEHIND, queue_size=WRITE_BEHIND_QUEUE_SIZE,
+                 batch_size=WRITE_BEHIND_BATCH_SIZE, max_delay=WRITE_BEHIND_MAX_DELAY):
+        self.db = db
+        self.write_behind = write_behind
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.queue = None
+        self.worker = None
+
+    async def write(self, turn):
+        committed = asyncio.get_running_loop().create_future()
+        if not self.write_behind:
+            await self.commit([turn])
+            committed.set_result(True)
+            return committed
+        if self.worker is None:
+            self.queue = asyncio.Queue(maxsize=self.queue_size)
+            self.worker = asyncio.create_task(self.run())
+        await self.queue.put((turn, committed))
+        return committed
+
+    async def commit(self, turns):
+        await self.db.save_turns([turn.session for turn in turns if turn.session],
+                                 [turn.document for turn in turns if turn.document],
+                                 [turn.chat for turn in turns],
+                                 [turn.context for turn in turns if turn.context])
+        turn_commits.inc()
+        turns_written.inc(len(turns), result='ok')
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            if self.queue.qsize() < self.batch_size - 1:
+                await asyncio.sleep(self.max_delay)
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                await self.commit_batch(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def commit_batch(self, batch):
+        try:
+            await self.commit([turn for turn, _ in batch])
+            results = [True]*len(batch)
+        except Exception:
+            # One bad row (e.g. a session deleted while its turn was queued) must not lose the rest of the batch
+            logger.exception("Batched write of %d turns failed, retrying them one by one", len(batch))
+            results = []
+            for turn, _ in batch:
+                try:
+                    await self.commit([turn])
+                    results.append(True)
+                except Exception:
+                    logger.exception("Could not persist chat %s", turn.chat['id'])
+                    turns_written.inc(result='error')
+                    results.append(False)
+        for (_, committed), result in zip(batch, results):
+            if not committed.done():
+                committed.set_result(result)
+
+    async def close(self):
+        # Flushes every queued turn before the database connection is closed
+        if self.worker is None:
+            return
+        await self.queue.join()
+        self.worker.cancel()
+        self.worker = None
@@ -0,0 +1,69 @@
+import hashlib
+from typing import NamedTuple
+from fastapi import HTTPException, status
+from fastapi.responses import JSONResponse
+
+UPLOAD_CHUNK_SIZE = 65536
+FORM_OVERHEAD = 65536   #Room for the multipart boundaries, headers and text fields around the file
+
+class Upload(NamedTuple):
+    filename: str
+    content_type: str
+    data: bytes
+    digest: str
+
+async def read_upload(file, max_size):
+    # Reads the body once, enforcing the size limit and hashing as it goes, and keeps it in memory
+    digest = hashlib.sha256()
+    chunks = []
+    size = 0
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_size:
+            raise too_large(max_size)
+        digest.update(chunk)
+        chunks.append(chunk)
+    return Upload(file.filename, file.content_type, b''.join(chunks), digest.hexdigest())
+
+
+def too_large(max_size):
+    return HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, 
+                         detail=f"File size exceeds {max_size//1048576}MB.")
+
+
+class UploadSizeLimit:
+    '''ASGI middleware rejecting oversized upload requests before their body is parsed.
+
+    The form parser spools files to disk as it reads them, so read_upload alone would only reject a large upload
+    once it had been received and written out. Requests announcing a larger body are answered at once; bodies
+    without a Content-Length are cut off as soon as they pass the limit.'''
+
+    def __init__(self, app, max_size, paths):
+        self.app = app
+        self.max_size = max_size
+        self.max_body = max_size + FORM_OVERHEAD
+        self.paths = tuple(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].endswith(self.paths):
+            return await self.app(scope, receive, send)
+        content_length = dict(scope['headers']).get(b'content-length')
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_body:
+            error = too_large(self.max_size)
+            response = JSONResponse({'detail': error.detail}, status_code=error.status_code, headers={'Connection': 'close'})
+            return await response(scope, receive, send)
+        received = 0
+
+        async def receive_limited():
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > self.max_body:
+                    raise too_large(self.max_size)
+            return message
+
+        await self.app(scope, receive_limited, send)